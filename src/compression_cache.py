@@ -0,0 +1,205 @@
+"""
+A content-addressed cache for compressed data on disk.
+
+Entries are keyed by the SHA-256 of the uncompressed data, the encoder, the compression level and
+the time budget of encoders that have one, so unchanged archives don't have to be compressed again on every build. The total size of the
+cache is capped; the least recently used entries are removed first.
+
+The cache lives in a directory of the current user that only they can access, and every entry
+stores the SHA-256 of its compressed data, which is checked when it's read.
+"""
+import hashlib
+import logging
+import os
+import stat
+import sys
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dirpath() -> str:
+    if os.name == 'nt':
+        base_dirpath = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), 'AppData', 'Local')
+    elif sys.platform == 'darwin':
+        base_dirpath = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base_dirpath = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dirpath, 'mkdd-track-patcher', 'compression-cache')
+
+
+DEFAULT_CACHE_DIRPATH = default_cache_dirpath()
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+_CACHE_EXTENSION = '.bin'
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class CompressionCache(object):
+
+    def __init__(self, dirpath: str = DEFAULT_CACHE_DIRPATH, max_size: int = DEFAULT_MAX_SIZE):
+        self.dirpath = dirpath
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        # Filename -> [size, last use time], filled from the cache directory on first use.
+        self._entries = None
+        self._total_size = 0
+        # Set on first use if the cache directory can't be used safely
+        self._disabled = False
+
+    @staticmethod
+    def make_key(data, encoder: str, level, time_budget: float = None) -> str:
+        key = f'{hashlib.sha256(data).hexdigest()}-{encoder}-{level}'
+        if time_budget is not None:
+            key += f'-{time_budget}s'
+        return key
+
+    def _check_dirpath(self) -> bool:
+        # Other users must not be able to put entries into the cache, as they end up in built archives.
+        os.makedirs(self.dirpath, mode=0o700, exist_ok=True)
+        if os.name != 'posix':
+            return True
+
+        dir_stat = os.lstat(self.dirpath)
+        if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid():
+            log.warning(f'Not using the compression cache, {self.dirpath} is not a directory of the current user')
+            return False
+        if dir_stat.st_mode & 0o077:
+            os.chmod(self.dirpath, 0o700)
+        return True
+
+    def _load_entries(self):
+        if self._entries is not None:
+            return
+
+        self._entries = {}
+        self._total_size = 0
+        try:
+            self._disabled = not self._check_dirpath()
+        except OSError as e:
+            log.warning(f'Not using the compression cache: {e}')
+            self._disabled = True
+        if self._disabled:
+            return
+
+        with os.scandir(self.dirpath) as it:
+            for entry in it:
+                if not entry.name.endswith(_CACHE_EXTENSION) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                self._entries[entry.name] = [stat.st_size, stat.st_mtime]
+                self._total_size += stat.st_size
+
+    def get(self, key: str) -> 'bytes | None':
+        with self._lock:
+            self._load_entries()
+        if self._disabled:
+            return None
+
+        filename = key + _CACHE_EXTENSION
+        filepath = os.path.join(self.dirpath, filename)
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        digest, compressed_data = data[:_DIGEST_SIZE], data[_DIGEST_SIZE:]
+        if hashlib.sha256(compressed_data).digest() != digest:
+            log.warning(f'Removing corrupted compression cache entry {filename}')
+            with self._lock:
+                self._remove_entry(filename)
+            return None
+
+        try:
+            # The modification time doubles as the last use time for the eviction order.
+            os.utime(filepath)
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            return None
+
+        with self._lock:
+            old_entry = self._entries.get(filename)
+            if old_entry is not None:
+                self._total_size -= old_entry[0]
+            self._entries[filename] = [len(data), mtime]
+            self._total_size += len(data)
+
+        return compressed_data
+
+    def put(self, key: str, data):
+        if len(data) > self.max_size:
+            return
+
+        filename = key + _CACHE_EXTENSION
+        filepath = os.path.join(self.dirpath, filename)
+
+        with self._lock:
+            self._load_entries()
+            if self._disabled:
+                return
+
+            # Write to a temporary file first so other processes never see a partial entry.
+            handle, tmp_filepath = tempfile.mkstemp(dir=self.dirpath, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as f:
+                    f.write(hashlib.sha256(data).digest())
+                    f.write(data)
+                os.replace(tmp_filepath, filepath)
+            except OSError as e:
+                log.warning(f'Unable to write compression cache entry: {e}')
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+                return
+
+            old_entry = self._entries.get(filename)
+            if old_entry is not None:
+                self._total_size -= old_entry[0]
+            self._entries[filename] = [_DIGEST_SIZE + len(data), os.path.getmtime(filepath)]
+            self._total_size += _DIGEST_SIZE + len(data)
+
+            self._evict()
+
+    def _remove_entry(self, filename: str):
+        try:
+            os.remove(os.path.join(self.dirpath, filename))
+        except OSError:
+            pass
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self._total_size -= entry[0]
+
+    def _evict(self):
+        if self._total_size <= self.max_size:
+            return
+
+        for filename, (size, _mtime) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            try:
+                os.remove(os.path.join(self.dirpath, filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning(f'Unable to remove compression cache entry: {e}')
+                continue
+
+            del self._entries[filename]
+            self._total_size -= size
+            if self._total_size <= self.max_size:
+                break
+
+    def get_or_compress(self, data, encoder: str, level, compress_func, time_budget: float = None) -> bytes:
+        """
+        Returns the cached result for the data, encoder, level and time budget, or calls
+        `compress_func` with the data and stores its result in the cache.
+        """
+        key = self.make_key(data, encoder, level, time_budget)
+        compressed_data = self.get(key)
+        if compressed_data is None:
+            compressed_data = bytes(compress_func(data))
+            self.put(key, compressed_data)
+        else:
+            log.debug(f'Using cached compressed data for {key}')
+
+        return compressed_data
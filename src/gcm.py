@@ -28,11 +28,31 @@ SOFTWARE.
 """
 
 import os
+import logging
+import mmap
+import struct
+import weakref
+from bisect import bisect_right
 from io import BytesIO
 
+try:
+  import fcntl
+except ImportError: # Not available on Windows
+  fcntl = None
+
 from .fs_helpers import *
 
+log = logging.getLogger(__name__)
+
 MAX_DATA_SIZE_TO_READ_AT_ONCE = 64*1024*1024 # 64MB
+COPY_BUFFER_SIZE = 8*1024*1024 # 8MB
+
+# ioctl that makes a file share the data of another file on filesystems with copy-on-write (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Ways to copy unchanged data from the input ISO to the output, from fastest to slowest.
+# The kernel copies the data directly for the first two, without it passing through Python.
+COPY_METHODS = ["copy_file_range", "sendfile", "readinto"]
 
 class GCM:
   def __init__(self, iso_path):
@@ -42,6 +62,15 @@ class GCM:
     self.dirs_by_path = {}
     self.dirs_by_path_lowercase = {}
     self.changed_files = {}
+    
+    self.iso_map = None
+    self.iso_view = None
+    # The DiscFileData objects that were handed out, so close can copy their data out of the mapping
+    self.disc_files = weakref.WeakSet()
+    
+    self.input_iso = None
+    self.copy_method = None
+    self.copy_buffer = None
   
   def read_entire_disc(self):
     self.iso_file = open(self.iso_path, "rb")
@@ -55,19 +84,38 @@ class GCM:
       self.iso_file.close()
       self.iso_file = None
     
-    for file_path, file_entry in self.files_by_path.items():
-      self.files_by_path_lowercase[file_path.lower()] = file_entry
-    for dir_path, file_entry in self.dirs_by_path.items():
-      self.dirs_by_path_lowercase[dir_path.lower()] = file_entry
+    for system_file in self.system_files:
+      self.files_by_path_lowercase[system_file.file_path.lower()] = system_file
   
   def read_filesystem(self):
-    self.file_entries = []
-    num_file_entries = read_u32(self.iso_file, self.fst_offset + 8)
+    # The whole FST is read at once and parsed from memory, instead of seeking to every field and
+    # every character of the names in the ISO.
+    self.iso_file.seek(self.fst_offset)
+    fst_data = self.iso_file.read(self.fst_size)
+    num_file_entries = struct.unpack_from(">I", fst_data, 8)[0]
     self.fnt_offset = self.fst_offset + num_file_entries*0xC
-    for file_index in range(num_file_entries):
-      file_entry_offset = self.fst_offset + file_index * 0xC
+    
+    fnt_data = fst_data[num_file_entries*0xC:]
+    names_by_offset = {}
+    name_offset = 0
+    for name in fnt_data.split(b"\0"):
+      names_by_offset[name_offset] = name
+      name_offset += len(name) + 1
+    
+    self.file_entries = []
+    fields = struct.iter_unpack(">III", fst_data[:num_file_entries*0xC])
+    for file_index, (is_dir_and_name_offset, file_data_offset_or_parent_fst_index, file_size_or_next_fst_index) in enumerate(fields):
+      if file_index == 0:
+        name = "" # Root
+      else:
+        name_offset = is_dir_and_name_offset & 0x00FFFFFF
+        name = names_by_offset.get(name_offset)
+        if name is None: # Name that starts inside of another name
+          name = fnt_data[name_offset:fnt_data.index(b"\0", name_offset)]
+        name = name.decode("shift_jis")
+      
       file_entry = FileEntry()
-      file_entry.read(file_index, self.iso_file, file_entry_offset, self.fnt_offset)
+      file_entry.read(file_index, is_dir_and_name_offset, file_data_offset_or_parent_fst_index, file_size_or_next_fst_index, name)
       self.file_entries.append(file_entry)
     
     root_file_entry = self.file_entries[0]
@@ -77,6 +125,7 @@ class GCM:
   def read_directory(self, directory_file_entry, dir_path):
     assert directory_file_entry.is_dir
     self.dirs_by_path[dir_path] = directory_file_entry
+    self.dirs_by_path_lowercase[dir_path.lower()] = directory_file_entry
     directory_file_entry.dir_path = dir_path
     
     i = directory_file_entry.file_index + 1
@@ -96,6 +145,7 @@ class GCM:
       else:
         file_path = dir_path + "/" + file_entry.name
         self.files_by_path[file_path] = file_entry
+        self.files_by_path_lowercase[file_path.lower()] = file_entry
         file_entry.file_path = file_path
         i += 1
   
@@ -136,29 +186,55 @@ class GCM:
     ]
   
   def read_file_data(self, file_path):
-    file_path = file_path.lower()
-    if file_path not in self.files_by_path_lowercase:
-      raise Exception("Could not find file: " + file_path)
-    
-    file_entry = self.files_by_path_lowercase[file_path]
-    if file_entry.file_size > MAX_DATA_SIZE_TO_READ_AT_ONCE:
-      raise Exception("Tried to read a very large file all at once")
-    with open(self.iso_path, "rb") as iso_file:
-      data = read_bytes(iso_file, file_entry.file_data_offset, file_entry.file_size)
-    data = BytesIO(data)
-    
-    return data
+    # Returns a file-like object for the data of the file in the input ISO. The data isn't copied unless
+    # it's changed, see DiscFileData.
+    file_data = DiscFileData(self.read_file_raw_data(file_path))
+    self.disc_files.add(file_data)
+    return file_data
   
   def read_file_raw_data(self, file_path):
+    # Returns a read-only memoryview of the data of the file in the input ISO
     file_path = file_path.lower()
     if file_path not in self.files_by_path_lowercase:
       raise Exception("Could not find file: " + file_path)
     
     file_entry = self.files_by_path_lowercase[file_path]
-    with open(self.iso_path, "rb") as iso_file:
-      data = read_bytes(iso_file, file_entry.file_data_offset, file_entry.file_size)
-    
-    return data
+    iso_view = self.map_input_iso()
+    return iso_view[file_entry.file_data_offset:file_entry.file_data_offset+file_entry.file_size]
+  
+  def map_input_iso(self):
+    # The input ISO is memory mapped once, on the first read of a file, and stays mapped until close is
+    # called, since the data returned by read_file_data and read_file_raw_data refers to it.
+    if self.iso_view is None:
+      with open(self.iso_path, "rb") as iso_file:
+        self.iso_map = mmap.mmap(iso_file.fileno(), 0, access=mmap.ACCESS_READ)
+      self.iso_view = memoryview(self.iso_map)
+    return self.iso_view
+  
+  def close(self):
+    # Unmaps the input ISO, which keeps it from being changed or deleted on Windows. The data of files
+    # returned by read_file_data is copied first, so they can still be used. Views returned by
+    # read_file_raw_data, and archives read from files of the ISO that weren't closed, keep the mapping
+    # open until they are released.
+    for file_data in list(self.disc_files):
+      file_data.make_writable()
+    self.disc_files = weakref.WeakSet()
+    self.close_input_iso()
+    
+    if self.iso_view is not None:
+      self.iso_view.release()
+      self.iso_view = None
+      try:
+        self.iso_map.close()
+      except BufferError:
+        log.warning("The input ISO is still in use and stays mapped until it's released")
+      self.iso_map = None
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, *args):
+    self.close()
   
   def get_dir_file_entry(self, dir_path):
     dir_path = dir_path.lower()
@@ -192,6 +268,13 @@ class GCM:
         self.add_new_file(file_path, data)
         
   def export_disc_to_folder_with_changed_files(self, output_folder_path):
+    self.open_input_iso()
+    try:
+      self.export_files_to_folder(output_folder_path)
+    finally:
+      self.close_input_iso()
+  
+  def export_files_to_folder(self, output_folder_path):
     for file_path, file_entry in self.files_by_path.items():
       full_file_path = os.path.join(output_folder_path, file_path)
       dir_name = os.path.dirname(full_file_path)
@@ -204,29 +287,102 @@ class GCM:
           file_data.seek(0)
           f.write(file_data.read())
       else:
-        # Need to avoid reading enormous files all at once
-        size_remaining = file_entry.file_size
-        offset_in_file = 0
         with open(full_file_path, "wb") as f:
-          while size_remaining > 0:
-            size_to_read = min(size_remaining, MAX_DATA_SIZE_TO_READ_AT_ONCE)
-            
-            with open(self.iso_path, "rb") as iso_file:
-              data = read_bytes(iso_file, file_entry.file_data_offset + offset_in_file, size_to_read)
-            f.write(data)
-            
-            size_remaining -= size_to_read
-            offset_in_file += size_to_read
+          self.copy_input_iso_data(f, file_entry.file_data_offset, file_entry.file_size)
   
   def export_disc_to_iso_with_changed_files(self, output_file_path):
     if os.path.realpath(self.iso_path) == os.path.realpath(output_file_path):
       raise Exception("Input ISO path and output ISO path are the same. Aborting.")
     
+    layout = self.plan_layout()
     self.output_iso = open(output_file_path, "wb")
+    self.open_input_iso()
     try:
-      self.export_system_data_to_iso()
-      self.export_filesystem_to_iso()
+      self.export_system_data_to_iso(layout)
+      self.export_filesystem_to_iso(layout)
+      self.output_iso.seek(layout["end"])
       self.align_output_iso_to_nearest(2048*16)
+      self.output_iso.truncate()
+    except:
+      self.output_iso.close()
+      os.remove(output_file_path)
+      raise
+    finally:
+      self.output_iso.close()
+      self.output_iso = None
+      self.close_input_iso()
+    
+    self.log_layout(layout)
+  
+  def open_input_iso(self):
+    # The input ISO stays open for the whole export instead of being opened again for every file
+    self.input_iso = open(self.iso_path, "rb")
+    if self.copy_method is None:
+      self.copy_method = next(method for method in COPY_METHODS if method == "readinto" or hasattr(os, method))
+  
+  def close_input_iso(self):
+    if self.input_iso is not None:
+      self.input_iso.close()
+      self.input_iso = None
+    self.copy_buffer = None
+  
+  def copy_input_iso_data(self, output_file, offset, size):
+    # Copies size bytes at offset in the input ISO to the current position of output_file.
+    # If the kernel can't copy between these files, the next method in COPY_METHODS is used
+    # from then on. The last one reads the data into a buffer that is reused for every copy.
+    output_offset = output_file.tell()
+    copied = 0
+    
+    if self.copy_method != "readinto":
+      output_file.flush()
+      input_fd = self.input_iso.fileno()
+      output_fd = output_file.fileno()
+    
+    while copied < size and self.copy_method != "readinto":
+      count = min(size - copied, MAX_DATA_SIZE_TO_READ_AT_ONCE)
+      try:
+        if self.copy_method == "copy_file_range":
+          copied_now = os.copy_file_range(input_fd, output_fd, count, offset + copied, output_offset + copied)
+        else:
+          os.lseek(output_fd, output_offset + copied, os.SEEK_SET)
+          copied_now = os.sendfile(output_fd, input_fd, offset + copied, count)
+      except OSError:
+        self.copy_method = COPY_METHODS[COPY_METHODS.index(self.copy_method) + 1]
+        continue
+      
+      if copied_now == 0:
+        # The rest is read normally instead, which also finds out whether the input ISO is too short
+        break
+      copied += copied_now
+    
+    output_file.seek(output_offset + copied)
+    
+    if copied < size:
+      if self.copy_buffer is None:
+        self.copy_buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+      
+      self.input_iso.seek(offset + copied)
+      while copied < size:
+        read_size = self.input_iso.readinto(self.copy_buffer[:min(size - copied, COPY_BUFFER_SIZE)])
+        if not read_size:
+          raise Exception("Input ISO ends at offset 0x%X, before the end of data at offset 0x%X." % (offset + copied, offset + size))
+        output_file.write(self.copy_buffer[:read_size])
+        copied += read_size
+  
+  def export_disc_to_iso_by_patching_copy(self, output_file_path):
+    # Alternative to export_disc_to_iso_with_changed_files with the same layout (see plan_layout). Instead of
+    # writing the whole ISO, the input ISO is cloned (see clone_input_iso) and only the changed and relocated
+    # files, the FST and the header fields are written to the copy. Unlike in a written ISO, space that is no
+    # longer used keeps the data of the input ISO instead of being zeroed.
+    if os.path.realpath(self.iso_path) == os.path.realpath(output_file_path):
+      raise Exception("Input ISO path and output ISO path are the same. Aborting.")
+    
+    layout = self.plan_layout()
+    self.output_iso = open(output_file_path, "w+b")
+    self.open_input_iso()
+    try:
+      self.clone_input_iso(self.output_iso)
+      self.patch_output_iso(layout)
     except:
       self.output_iso.close()
       os.remove(output_file_path)
@@ -234,6 +390,198 @@ class GCM:
     finally:
       self.output_iso.close()
       self.output_iso = None
+      self.close_input_iso()
+    
+    self.log_layout(layout)
+  
+  def get_original_regions(self):
+    # Offset and size of every part of the input ISO: the system data, the DOL, the FST and the files
+    regions = [
+      (0, 0x2440 + self.files_by_path["sys/apploader.img"].file_size),
+    ]
+    for file_path in ("sys/main.dol", "sys/fst.bin"):
+      system_file = self.files_by_path[file_path]
+      regions.append((system_file.file_data_offset, system_file.file_size))
+    for file_entry in self.files_by_path.values():
+      if not file_entry.is_system_file and file_entry.file_size is not None:
+        regions.append((file_entry.file_data_offset, file_entry.file_size))
+    return regions
+  
+  def plan_layout(self):
+    # Decides where the DOL, the FST and the files go in the output ISO. Everything stays at its offset
+    # in the input ISO if it still fits into its slot, i.e. the space up to the next region of the input ISO,
+    # which includes the padding after it. Everything else (grown files, files whose data is shared with
+    # another file, new files) is relocated into the gaps that are left, biggest first, or to the end.
+    # Returns a dict with the offsets, the FST data with the offsets and sizes of the files filled in, the
+    # end of the data and the number of bytes of relocated and new files.
+    self.recalculate_file_entry_indexes()
+    fst_data = BytesIO()
+    fst_size = self.write_fst(fst_data, 0)
+    
+    regions = self.get_original_regions()
+    starts = sorted(set(offset for offset, size in regions))
+    
+    # Data that is used by several file entries can't be overwritten for just one of them
+    shared_starts = set()
+    seen_starts = set()
+    for offset, size in regions:
+      if size > 0:
+        if offset in seen_starts:
+          shared_starts.add(offset)
+        seen_starts.add(offset)
+    
+    def fits_in_slot(offset, size):
+      index = bisect_right(starts, offset)
+      return index == len(starts) or offset + size <= starts[index]
+    
+    # boot.bin, bi2.bin and the apploader can't be moved
+    system_end = 0x2440 + data_len(self.get_changed_file_data("sys/apploader.img"))
+    
+    # Items are (key, offset in the input ISO or None for new files, size, alignment, is_changed)
+    dol = self.files_by_path["sys/main.dol"]
+    fst = self.files_by_path["sys/fst.bin"]
+    items = [
+      ("dol", dol.file_data_offset, data_len(self.get_changed_file_data("sys/main.dol")), 0x100, "sys/main.dol" in self.changed_files),
+      ("fst", fst.file_data_offset, fst_size, 0x100, True),
+    ]
+    for file_entry in self.file_entries:
+      if file_entry.is_dir:
+        continue
+      if file_entry.file_path in self.changed_files:
+        items.append((file_entry, file_entry.file_size and file_entry.file_data_offset, data_len(self.changed_files[file_entry.file_path]), 4, True))
+      else:
+        items.append((file_entry, file_entry.file_data_offset, file_entry.file_size, 4, False))
+    
+    offsets = {}
+    relocated_items = []
+    for key, original_offset, size, alignment, is_changed in items:
+      if (original_offset is not None and original_offset >= system_end and fits_in_slot(original_offset, size)
+          and not (is_changed and original_offset in shared_starts)):
+        offsets[key] = original_offset
+      else:
+        relocated_items.append((key, original_offset, size, alignment))
+    
+    # The gaps between the items that stay in place
+    gaps = []
+    end_offset = system_end
+    for offset, size in sorted((offsets[key], size) for key, _, size, _, _ in items if key in offsets):
+      if offset > end_offset:
+        gaps.append([end_offset, offset])
+      end_offset = max(end_offset, offset + size)
+    
+    relocated_bytes = 0
+    new_bytes = 0
+    relocated_items.sort(key=lambda item: item[2], reverse=True)
+    for key, original_offset, size, alignment in relocated_items:
+      for gap in gaps:
+        offset = (gap[0] + alignment - 1) & ~(alignment - 1)
+        if offset + size <= gap[1]:
+          gap[0] = offset + size
+          break
+      else:
+        offset = (end_offset + alignment - 1) & ~(alignment - 1)
+        end_offset = offset + size
+      
+      offsets[key] = offset
+      if original_offset is None:
+        new_bytes += size
+      else:
+        relocated_bytes += size
+    
+    files = {}
+    for key, _, size, _, _ in items[2:]:
+      files[key] = (offsets[key], size)
+      write_u32(fst_data, key.file_index*0xC + 4, offsets[key])
+      write_u32(fst_data, key.file_index*0xC + 8, size)
+    
+    return {
+      "dol": offsets["dol"],
+      "fst": offsets["fst"],
+      "fst_data": fst_data.getvalue(),
+      "files": files,
+      "end": end_offset,
+      "relocated_bytes": relocated_bytes,
+      "new_bytes": new_bytes,
+    }
+  
+  def log_layout(self, layout):
+    log.info("%d bytes of files relocated, %d bytes of new files", layout["relocated_bytes"], layout["new_bytes"])
+  
+  def clone_input_iso(self, output_file):
+    # Makes output_file a copy of the input ISO. On filesystems with copy-on-write the copy shares the data
+    # of the input ISO, so no data is copied at all. Otherwise only the parts of the input ISO that aren't
+    # holes are copied.
+    input_fd = self.input_iso.fileno()
+    if fcntl is not None:
+      try:
+        fcntl.ioctl(output_file.fileno(), FICLONE, input_fd)
+        return
+      except OSError:
+        pass
+    
+    iso_size = os.fstat(input_fd).st_size
+    if not hasattr(os, "SEEK_DATA"):
+      self.copy_input_iso_data(output_file, 0, iso_size)
+      return
+    
+    # A separate descriptor is used for finding the data so the position of the input ISO's file object stays valid
+    scan_fd = os.open(self.iso_path, os.O_RDONLY)
+    try:
+      offset = 0
+      while offset < iso_size:
+        try:
+          data_start = os.lseek(scan_fd, offset, os.SEEK_DATA)
+        except OSError: # No data after offset
+          break
+        data_end = os.lseek(scan_fd, data_start, os.SEEK_HOLE)
+        output_file.seek(data_start)
+        self.copy_input_iso_data(output_file, data_start, data_end - data_start)
+        offset = data_end
+    finally:
+      os.close(scan_fd)
+    output_file.truncate(iso_size)
+  
+  def patch_output_iso(self, layout):
+    # Writes everything that differs from the input ISO into its clone
+    for file_path, offset in (("sys/boot.bin", 0), ("sys/bi2.bin", 0x440), ("sys/apploader.img", 0x2440)):
+      if file_path in self.changed_files:
+        file_data = self.changed_files[file_path]
+        file_data.seek(0)
+        write_bytes(self.output_iso, offset, file_data.read())
+    
+    dol = self.files_by_path["sys/main.dol"]
+    if "sys/main.dol" in self.changed_files:
+      dol_data = self.changed_files["sys/main.dol"]
+      dol_data.seek(0)
+      write_bytes(self.output_iso, layout["dol"], dol_data.read())
+    elif layout["dol"] != dol.file_data_offset:
+      self.output_iso.seek(layout["dol"])
+      self.copy_input_iso_data(self.output_iso, dol.file_data_offset, dol.file_size)
+    
+    for file_entry, (offset, file_size) in layout["files"].items():
+      if file_entry.file_path in self.changed_files:
+        file_data = self.changed_files[file_entry.file_path]
+        file_data.seek(0)
+        write_bytes(self.output_iso, offset, file_data.read())
+      elif offset != file_entry.file_data_offset:
+        self.output_iso.seek(offset)
+        self.copy_input_iso_data(self.output_iso, file_entry.file_data_offset, file_size)
+    
+    self.write_fst_and_header(layout)
+    
+    self.output_iso.seek(0, 2)
+    self.align_output_iso_to_nearest(2048*16)
+  
+  def write_fst_and_header(self, layout):
+    self.fst_offset = layout["fst"]
+    self.fst_size = len(layout["fst_data"])
+    self.fnt_offset = self.fst_offset + len(self.file_entries)*0xC
+    write_bytes(self.output_iso, self.fst_offset, layout["fst_data"])
+    
+    write_u32(self.output_iso, 0x420, layout["dol"])
+    write_u32(self.output_iso, 0x424, self.fst_offset)
+    write_u32(self.output_iso, 0x428, self.fst_size)
+    write_u32(self.output_iso, 0x42C, self.fst_size) # Seems to be a duplicate size field that must also be updated
   
   def get_changed_file_data(self, file_path):
     if file_path in self.changed_files:
@@ -250,7 +598,7 @@ class GCM:
     new_file = FileEntry()
     new_file.name = basename
     new_file.file_path = file_path
-    # file_data_offset is used for ordering the files in the new ISO, so we give it a huge value so new files are placed after vanilla files.
+    # New files have no data in the input ISO. Because file_size is None, plan_layout ignores file_data_offset and places them in a gap or after the other files.
     new_file.file_data_offset = (1<<32)
     new_file.file_size = None # No original file size.
     
@@ -284,7 +632,7 @@ class GCM:
     padding_needed = next_offset - current_offset
     self.pad_output_iso_by(padding_needed)
   
-  def export_system_data_to_iso(self):
+  def export_system_data_to_iso(self, layout):
     boot_bin_data = self.get_changed_file_data("sys/boot.bin")
     assert data_len(boot_bin_data) == 0x440
     self.output_iso.seek(0)
@@ -307,53 +655,37 @@ class GCM:
     apploader_data.seek(0)
     self.output_iso.write(apploader_data.read())
     
-    self.pad_output_iso_by(0x20)
-    self.align_output_iso_to_nearest(0x100)
-    
-    dol_offset = self.output_iso.tell()
     dol_data = self.get_changed_file_data("sys/main.dol")
-    dol_size = data_len(dol_data)
     dol_data.seek(0)
-    self.output_iso.write(dol_data.read())
-    write_u32(self.output_iso, 0x420, dol_offset)
-    self.output_iso.seek(dol_offset + dol_size)
-    
-    self.pad_output_iso_by(0x20)
-    self.align_output_iso_to_nearest(0x100)
-    
-    
-    # Write the FST and FNT to the ISO.
-    # File offsets and file sizes are left at 0, they will be filled in as the actual file data is written to the ISO.
-    self.recalculate_file_entry_indexes()
-    self.fst_offset = self.output_iso.tell()
-    write_u32(self.output_iso, 0x424, self.fst_offset)
-    self.fnt_offset = self.fst_offset + len(self.file_entries)*0xC
-    
-    file_entry_offset = self.fst_offset
-    next_name_offset = self.fnt_offset
+    write_bytes(self.output_iso, layout["dol"], dol_data.read())
+  
+  def write_fst(self, output, fst_offset):
+    # Writes the FST and FNT of the current file entries to output at fst_offset and returns their size.
+    # File offsets and file sizes are left at 0.
+    fnt_offset = fst_offset + len(self.file_entries)*0xC
+    file_entry_offset = fst_offset
+    next_name_offset = fnt_offset
     for file_index, file_entry in enumerate(self.file_entries):
-      file_entry.name_offset = next_name_offset - self.fnt_offset
+      file_entry.name_offset = next_name_offset - fnt_offset
       
       is_dir_and_name_offset = 0
       if file_entry.is_dir:
         is_dir_and_name_offset |= 0x01000000
       is_dir_and_name_offset |= (file_entry.name_offset & 0x00FFFFFF)
-      write_u32(self.output_iso, file_entry_offset, is_dir_and_name_offset)
+      write_u32(output, file_entry_offset, is_dir_and_name_offset)
       
       if file_entry.is_dir:
-        write_u32(self.output_iso, file_entry_offset+4, file_entry.parent_fst_index)
-        write_u32(self.output_iso, file_entry_offset+8, file_entry.next_fst_index)
+        write_u32(output, file_entry_offset+4, file_entry.parent_fst_index)
+        write_u32(output, file_entry_offset+8, file_entry.next_fst_index)
       
       file_entry_offset += 0xC
       
       if file_index != 0: # Root doesn't have a name
-        write_str_with_null_byte(self.output_iso, next_name_offset, file_entry.name)
+        write_str_with_null_byte(output, next_name_offset, file_entry.name)
         next_name_offset += len(file_entry.name)+1
     
-    self.fst_size = self.output_iso.tell() - self.fst_offset
-    write_u32(self.output_iso, 0x428, self.fst_size)
-    write_u32(self.output_iso, 0x42C, self.fst_size) # Seems to be a duplicate size field that must also be updated
-    self.output_iso.seek(self.fst_offset + self.fst_size)
+    output.seek(next_name_offset)
+    return next_name_offset - fst_offset
   
   def recalculate_file_entry_indexes(self):
     root = self.file_entries[0]
@@ -373,57 +705,24 @@ class GCM:
       
       curr_file_entry.next_fst_index = len(self.file_entries)
   
-  def export_filesystem_to_iso(self):
-    # Updates file offsets and sizes in the FST, and writes the files to the ISO.
-    
-    file_data_start_offset = self.fst_offset + self.fst_size
-    self.output_iso.seek(file_data_start_offset)
-    self.align_output_iso_to_nearest(4)
-    
-    # Instead of writing the file data in the order of file entries, write them in the order they were written in the vanilla ISO.
-    # This increases the speed the game loads file for some unknown reason.
-    file_entries_by_data_order = [
-      file_entry for file_entry in self.file_entries
-      if not file_entry.is_dir
-    ]
-    file_entries_by_data_order.sort(key=lambda fe: fe.file_data_offset)
-    
-    for file_entry in file_entries_by_data_order:
-      current_file_start_offset = self.output_iso.tell()
-      
+  def export_filesystem_to_iso(self, layout):
+    # Writes the files to the ISO at the offsets from the layout, in the order of their offsets, then the FST.
+    written = set()
+    for file_entry, (offset, file_size) in sorted(layout["files"].items(), key=lambda item: item[1]):
       if file_entry.file_path in self.changed_files:
         file_data = self.changed_files[file_entry.file_path]
         file_data.seek(0)
-        self.output_iso.write(file_data.read())
-      else:
+        write_bytes(self.output_iso, offset, file_data.read())
+      elif (offset, file_size) not in written: # Files that share their data in the input ISO still do
         # Unchanged file.
-        # Most of the game's data falls into this category, so we read the data directly instead of calling read_file_data which would create a BytesIO object, which would add unnecessary performance overhead.
-        # Also, we need to read very large files in chunks to avoid running out of memory.
-        size_remaining = file_entry.file_size
-        offset_in_file = 0
-        while size_remaining > 0:
-          size_to_read = min(size_remaining, MAX_DATA_SIZE_TO_READ_AT_ONCE)
-          
-          with open(self.iso_path, "rb") as iso_file:
-            data = read_bytes(iso_file, file_entry.file_data_offset + offset_in_file, size_to_read)
-          self.output_iso.write(data)
-          
-          size_remaining -= size_to_read
-          offset_in_file += size_to_read
-      
-      file_entry_offset = self.fst_offset + file_entry.file_index*0xC
-      write_u32(self.output_iso, file_entry_offset+4, current_file_start_offset)
-      if file_entry.file_path in self.changed_files:
-        file_size = data_len(self.changed_files[file_entry.file_path])
-      else:
-        file_size = file_entry.file_size
-      write_u32(self.output_iso, file_entry_offset+8, file_size)
+        # Most of the game's data falls into this category, so it's copied directly from the input ISO instead of calling read_file_data which would create a BytesIO object, which would add unnecessary performance overhead.
+        self.output_iso.seek(offset)
+        self.copy_input_iso_data(self.output_iso, file_entry.file_data_offset, file_size)
+        written.add((offset, file_size))
       
       # Note: The file_data_offset and file_size fields of the FileEntry must not be updated, they refer only to the offset and size of the file data in the input ISO, not this output ISO.
-      
-      self.output_iso.seek(current_file_start_offset + file_size)
-      
-      self.align_output_iso_to_nearest(4)
+    
+    self.write_fst_and_header(layout)
 
 class FileEntry:
   def __init__(self):
@@ -432,16 +731,13 @@ class FileEntry:
     self.is_dir = False
     self.is_system_file = False
   
-  def read(self, file_index, iso_file, file_entry_offset, fnt_offset):
+  def read(self, file_index, is_dir_and_name_offset, file_data_offset_or_parent_fst_index, file_size_or_next_fst_index, name):
+    # Takes the fields of the entry in the FST and its name from the FNT
     self.file_index = file_index
     
-    is_dir_and_name_offset = read_u32(iso_file, file_entry_offset)
-    file_data_offset_or_parent_fst_index = read_u32(iso_file, file_entry_offset+4)
-    file_size_or_next_fst_index = read_u32(iso_file, file_entry_offset+8)
-    
     self.is_dir = ((is_dir_and_name_offset & 0xFF000000) != 0)
     self.name_offset = (is_dir_and_name_offset & 0x00FFFFFF)
-    self.name = ""
+    self.name = name
     if self.is_dir:
       self.parent_fst_index = file_data_offset_or_parent_fst_index
       self.next_fst_index = file_size_or_next_fst_index
@@ -450,11 +746,99 @@ class FileEntry:
       self.file_data_offset = file_data_offset_or_parent_fst_index
       self.file_size = file_size_or_next_fst_index
     self.parent = None
+
+class DiscFileData:
+  # A file-like object for the data of a file in the input ISO that doesn't copy the data until it's changed.
+  # Reading is done directly from a read-only view into the memory mapped input ISO. Writing, truncating
+  # and getbuffer first copy the data into a BytesIO that is used from then on.
+  def __init__(self, view):
+    self.view = view
+    self.data = None
+    self.pos = 0
+  
+  def make_writable(self):
+    if self.data is None:
+      self.data = BytesIO(self.view)
+      self.data.seek(self.pos)
+      self.view = None
+  
+  def getview(self):
+    # Read-only memoryview of the data that is only a copy if the data was changed
+    if self.data is not None:
+      return memoryview(self.data.getvalue())
+    return self.view
+  
+  def getvalue(self):
+    if self.data is not None:
+      return self.data.getvalue()
+    return bytes(self.view)
+  
+  def read(self, size=-1):
+    if self.data is not None:
+      return self.data.read(size)
     
-    if file_index == 0:
-      self.name = "" # Root
+    start = min(self.pos, len(self.view))
+    if size is None or size < 0:
+      end = len(self.view)
     else:
-      self.name = read_str_until_null_character(iso_file, fnt_offset + self.name_offset)
+      end = min(start + size, len(self.view))
+    self.pos = max(self.pos, end)
+    return bytes(self.view[start:end])
+  
+  def readinto(self, b):
+    if self.data is not None:
+      return self.data.readinto(b)
+    
+    with memoryview(b) as output:
+      output = output.cast("B")
+      start = min(self.pos, len(self.view))
+      size = min(len(output), len(self.view) - start)
+      output[:size] = self.view[start:start+size]
+    self.pos = max(self.pos, start + size)
+    return size
+  
+  def seek(self, pos, whence=0):
+    if self.data is not None:
+      return self.data.seek(pos, whence)
+    
+    if whence == 0 and pos < 0:
+      raise ValueError("negative seek value %d" % pos)
+    if whence == 1:
+      pos = max(0, self.pos + pos)
+    elif whence == 2:
+      pos = max(0, len(self.view) + pos)
+    self.pos = pos
+    return pos
+  
+  def tell(self):
+    if self.data is not None:
+      return self.data.tell()
+    return self.pos
+  
+  def write(self, b):
+    self.make_writable()
+    return self.data.write(b)
+  
+  def writelines(self, lines):
+    self.make_writable()
+    self.data.writelines(lines)
+  
+  def truncate(self, size=None):
+    self.make_writable()
+    return self.data.truncate(size)
+  
+  def getbuffer(self):
+    self.make_writable()
+    return self.data.getbuffer()
+  
+  def readable(self):
+    return True
+  
+  def writable(self):
+    return True
+  
+  def seekable(self):
+    return True
 
 class SystemFile:
   def __init__(self, file_data_offset, file_size, name):
@@ -552,17 +552,20 @@ def rename_archive(arc, newname, mp):
         arc (str): arc file name
         newname (str): New name to change to
         mp (bool): Whether to modify the multiplayer level or not
+
+    Raises:
+        FileExistsError: If a renamed file would replace another file of the archive
     """
-    arc.root.name = newname+"l" if mp else newname
+    # Renaming through the archive keeps its path index up to date
+    arc.rename(arc.root.name, newname+"l" if mp else newname)
 
     rename = []
 
-    for filename, file in arc.root.files.items():
+    for filename in arc.root.files:
         if "_" in filename:
-            rename.append((filename, file))
+            rename.append(filename)
 
-    for filename, file in rename:
-        del arc.root.files[filename]
+    for filename in rename:
         name, rest = filename.split("_", 1)
 
         if newname == "luigi2":
@@ -570,8 +573,7 @@ def rename_archive(arc, newname, mp):
         else:
             newfilename = newname + "_" + rest
 
-        file.name = newfilename
-        arc.root.files[newfilename] = file
+        arc.rename(arc.root.name + "/" + filename, newfilename)
 
 
 SUPPORTED_CODE_PATCHES = tuple()  # No built-in support at the moment.
@@ -782,8 +784,10 @@ def patch(
                     conflicts.add_conflict(arc + "/" + file, mod_name)
 
                 newarc = BytesIO()
-                destination_arc.write_arc_uncompressed(newarc)
+                destination_arc.write_arc_in_place(newarc)
                 newarc.seek(0)
+                # Archives read from the ISO are closed so the ISO can be unmapped at the end
+                destination_arc.close()
 
                 patcher.change_file(srcarcpath, newarc)
 
@@ -803,12 +807,14 @@ def patch(
 
                 race2d_arc_file = mram_arc["mram/race2d.arc"]
                 race2d_arc_file.seek(0)
-                race2d_arc.write_arc_uncompressed(race2d_arc_file)
+                race2d_arc.write_arc_in_place(race2d_arc_file)
+                race2d_arc.close()
                 #race2d_arc_file.truncate()
 
                 newarc = BytesIO()
-                mram_arc.write_arc_uncompressed(newarc)
+                mram_arc.write_arc_in_place(newarc)
                 newarc.seek(0)
+                mram_arc.close()
 
                 patcher.change_file("files/MRAM.arc", newarc)
 
@@ -920,11 +926,11 @@ def patch(
                 _, trackimage, trackname = battle_mapping[replace]
 
             # Copy track arc
-            track_arc = Archive.from_file(patcher.zip_open("track.arc"))
+            track_arc = patcher.open_archive("track.arc", validate_yaz0=True)
             if patcher.src_file_exists("track_mp.arc"):
-                track_mp_arc = Archive.from_file(patcher.zip_open("track_mp.arc"))
+                track_mp_arc = patcher.open_archive("track_mp.arc", validate_yaz0=True)
             else:
-                track_mp_arc = Archive.from_file(patcher.zip_open("track.arc"))
+                track_mp_arc = patcher.open_archive("track.arc", validate_yaz0=True)
 
             # Patch minimap settings in dol
             dol = DolFile(patcher.get_iso_file("sys/main.dol"))
@@ -1020,12 +1026,14 @@ def patch(
                         "courseselect/timg/{}".format(trackimage))
 
                     newarc = BytesIO()
-                    coursename_arc.write_arc_uncompressed(newarc)
+                    coursename_arc.write_arc_in_place(newarc)
                     newarc.seek(0)
 
                     newarc_mp = BytesIO()
-                    courseselect_arc.write_arc_uncompressed(newarc_mp)
+                    courseselect_arc.write_arc_in_place(newarc_mp)
                     newarc_mp.seek(0)
+                    coursename_arc.close()
+                    courseselect_arc.close()
 
                     patcher.change_file(coursename_arc_path, newarc)
                     patcher.change_file(courseselect_arc_path, newarc_mp)
@@ -1041,8 +1049,9 @@ def patch(
                         "mapselect/timg/{}".format(trackimage))
 
                     newarc_mapselect = BytesIO()
-                    mapselect_arc.write_arc_uncompressed(newarc_mapselect)
+                    mapselect_arc.write_arc_in_place(newarc_mapselect)
                     newarc_mapselect.seek(0)
+                    mapselect_arc.close()
 
                     patcher.change_file(mapselect_arc_path, newarc_mapselect)
 
@@ -1051,8 +1060,9 @@ def patch(
                                            lanplay_arc, "lanplay/timg/{}".format(trackname))
 
                 newarc_lan = BytesIO()
-                lanplay_arc.write_arc_uncompressed(newarc_lan)
+                lanplay_arc.write_arc_in_place(newarc_lan)
                 newarc_lan.seek(0)
+                lanplay_arc.close()
 
                 patcher.change_file(lanplay_arc_path, newarc_lan)
 
@@ -1247,3 +1257,6 @@ def patch(
                 "{0} zip file(s) skipped due to not being race tracks or mods.".format(skipped))
 
         log.info("finished writing iso, you are good to go!")
+    finally:
+        # Unmaps the input ISO
+        iso.close()
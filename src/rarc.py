@@ -1,13 +1,17 @@
 import os 
 import time
+import mmap
+import hashlib
 import logging
 import tempfile
 import subprocess 
 
 from io import BytesIO
 from itertools import chain
-from struct import pack, unpack
-from .yaz0 import decompress, compress_fast, read_uint32, read_uint16
+from struct import pack, pack_into, unpack_from, Struct
+from . import wszst as wszst_tool
+from .compression_cache import CompressionCache
+from .yaz0 import compress_many as yaz0_compress_many, decompress_buffer, decompress_stream, decompress_to_file, read_decompressed_size, validate, Yaz0Decoder, compress_parallel, DEFAULT_LEVEL, OPTIMAL_LEVEL, OPTIMAL_FALLBACK_LEVEL, OPTIMAL_TIME_BUDGET
 
 log = logging.getLogger(__name__)
 
@@ -29,11 +33,101 @@ def write_pad32(f):
 
 
 class CompressionSetting(object):
-    def __init__(self, yaz0_fast=False, wszst=False, compression_level="9"):
+    def __init__(self, yaz0_fast=False, wszst=False, compression_level="9", yaz0=False, yaz0_level=DEFAULT_LEVEL,
+                 workers=None, cache=None, wszst_executable=wszst_tool.WSZST_EXECUTABLE, yaz0_time_budget=None):
         self.yaz0_fast = yaz0_fast 
         self.wszst = wszst 
         self.compression_level = compression_level
-    
+        # Built-in Yaz0 encoder, yaz0_level goes from 1 (fastest) to 10 (optimal parse, smallest)
+        self.yaz0 = yaz0
+        self.yaz0_level = yaz0_level
+        # Seconds the optimal parse of level 10 may take per archive before it falls back to a faster level
+        self.yaz0_time_budget = yaz0_time_budget
+        # Number of processes used by the built-in encoder for large archives, None means one per CPU
+        self.workers = workers
+        # CompressionCache that stores compressed data across runs, None to always compress
+        self.cache = cache
+        self.wszst_executable = wszst_executable
+        self._wszst_pool = None
+
+    def _time_budget(self, encoder, level):
+        # Only the optimal parse has a time budget, which changes the result when it runs out
+        if encoder == "yaz0" and level == OPTIMAL_LEVEL:
+            return OPTIMAL_TIME_BUDGET if self.yaz0_time_budget is None else self.yaz0_time_budget
+        return None
+
+    def _encoder(self):
+        if self.yaz0_fast:
+            return "yaz0", 1
+        elif self.yaz0:
+            return "yaz0", self.yaz0_level
+        elif self.wszst:
+            return "wszst", self.compression_level
+        else:
+            raise RuntimeError("No compression is used")
+
+    def compress(self, data):
+        # Compresses data with the encoder that is selected in the settings
+        encoder, level = self._encoder()
+
+        if encoder == "wszst":
+            compress_func = lambda data: self.run_wszst(BytesIO(data))
+        else:
+            compress_func = lambda data: compress_parallel(data, self.workers, level, self.yaz0_time_budget)
+
+        if self.cache is None:
+            return compress_func(data)
+        else:
+            return self.cache.get_or_compress(data, encoder, level, compress_func,
+                                              self._time_budget(encoder, level))
+
+    def compress_many(self, datas):
+        # Like compress, but all inputs that aren't cached yet are compressed at the same time:
+        # by the built-in encoder on a pool of processes, or by a pool of wszst processes that
+        # handle several inputs per launch.
+        encoder, level = self._encoder()
+
+        results = [None]*len(datas)
+        keys = [None]*len(datas)
+        missing = []
+        for i, data in enumerate(datas):
+            if self.cache is not None:
+                keys[i] = self.cache.make_key(data, encoder, level, self._time_budget(encoder, level))
+                results[i] = self.cache.get(keys[i])
+            if results[i] is None:
+                missing.append(i)
+
+        if missing:
+            if encoder == "wszst":
+                if self._wszst_pool is None:
+                    self._wszst_pool = wszst_tool.WszstPool(self.compression_level, self.wszst_executable,
+                                                            self.workers)
+                compressed_datas = [self._smaller(datas[i], compressed_data) for i, compressed_data in
+                                    zip(missing, self._wszst_pool.map([datas[i] for i in missing]))]
+            else:
+                compressed_datas = yaz0_compress_many([datas[i] for i in missing], self.workers, level,
+                                                      self.yaz0_time_budget)
+
+            for i, compressed_data in zip(missing, compressed_datas):
+                results[i] = compressed_data
+                if self.cache is not None:
+                    self.cache.put(keys[i], results[i])
+
+        return results
+
+    def close(self):
+        if self._wszst_pool is not None:
+            self._wszst_pool.close()
+            self._wszst_pool = None
+
+    @staticmethod
+    def _smaller(filedata, compressed_data):
+        if len(filedata) >= len(compressed_data):
+            return compressed_data
+        else:
+            log.warning("Compressed data bigger than original, using uncompressed data")
+            return bytes(filedata)
+
     def run_wszst(self, file):
         if not self.wszst:
             raise RuntimeError("Wszst is not used")
@@ -46,7 +140,7 @@ class CompressionSetting(object):
             f.close()
         
         outpath = abspath+".yaz0_tmp"
-        args = ["wszst", "COMPRESS", abspath, "--dest", outpath, "--compr", self.compression_level]
+        args = [self.wszst_executable, "COMPRESS", abspath, "--dest", outpath, "--compr", self.compression_level]
         try:
             subprocess.run(args, check=True)
         except Exception as err:
@@ -60,11 +154,7 @@ class CompressionSetting(object):
         os.remove(abspath)
         os.remove(outpath)
         
-        if len(filedata) >= len(compressed_data):
-            return compressed_data 
-        else:
-            log.warning("Compressed data bigger than original, using uncompressed data")
-            return filedata 
+        return self._smaller(filedata, compressed_data)
 
 
 
@@ -74,46 +164,53 @@ COMPRESSED = 0x04
 DATA_FILE = 0x10 # unsure, opposed to REL file?
 REL_FILE = 0x20 # REL = dynamic link libraries
 YAZ0 = 0x80 # if not set but COMPRESSED is set, use yay0?
+# The flags that FileListing knows about
+FILELISTING_FLAGS = FILE | DIRECTORY | COMPRESSED | DATA_FILE | REL_FILE | YAZ0
+
+def _flag_property(flag):
+    def get(self):
+        return self.flags & flag != 0
+
+    def set(self, value):
+        if value:
+            self.flags |= flag
+        else:
+            self.flags &= ~flag
+
+    return property(get, set)
 
 class FileListing(object):
+    # The flags of a file entry, stored as the flag bits of the entry
+    __slots__ = ("flags",)
+
     def __init__(self, is_file, is_dir, is_compressed, is_data, is_rel, is_yaz0):
-        self.is_file = is_file 
-        self.is_dir = is_dir 
-        self.is_compressed = is_compressed
-        self.is_data = is_data 
-        self.is_rel = is_rel
-        self.is_yaz0 = is_yaz0 
-    
+        self.flags = ((FILE if is_file else 0)
+                      | (DIRECTORY if is_dir else 0)
+                      | (COMPRESSED if is_compressed else 0)
+                      | (DATA_FILE if is_data else 0)
+                      | (REL_FILE if is_rel else 0)
+                      | (YAZ0 if is_yaz0 else 0))
+
+    is_file = _flag_property(FILE)
+    is_dir = _flag_property(DIRECTORY)
+    is_compressed = _flag_property(COMPRESSED)
+    is_data = _flag_property(DATA_FILE)
+    is_rel = _flag_property(REL_FILE)
+    is_yaz0 = _flag_property(YAZ0)
+
     @classmethod
     def from_flags(cls, flags):
         if flags & 0x40:
             log.info("Unknown flag 0x40 set")
         if flags & 0x8:
             log.info("Unknown flag 0x8 set")
-            
-        return cls( flags & FILE != 0,
-                    flags & DIRECTORY != 0,
-                    flags & COMPRESSED != 0,
-                    flags & DATA_FILE != 0,
-                    flags & REL_FILE != 0,
-                    flags & YAZ0 != 0)
-    
+
+        listing = cls.__new__(cls)
+        listing.flags = flags & FILELISTING_FLAGS
+        return listing
+
     def to_flags(self):
-        result = 0
-        if self.is_file:
-            result |= FILE 
-        if self.is_dir:
-            result |= DIRECTORY  
-        if self.is_compressed:
-            result |= COMPRESSED
-        if self.is_data:
-            result |= DATA_FILE 
-        if self.is_rel:
-            result |= REL_FILE
-        if self.is_yaz0:
-            result |= YAZ0 
-        
-        return result 
+        return self.flags
     
     def to_string(self):
         result = []
@@ -150,10 +247,16 @@ class FileListing(object):
         return cls(True, False, False, True, False, False)
     
     def __str__(self):
-        return str(self.__dict__)
+        return str({"is_file": self.is_file, "is_dir": self.is_dir, "is_compressed": self.is_compressed,
+                    "is_data": self.is_data, "is_rel": self.is_rel, "is_yaz0": self.is_yaz0})
     
 DATA = [0]
 
+HEADER_STRUCT = Struct(">4sIIIIIII")
+INFO_STRUCT = Struct(">IIIIIIII")
+NODE_STRUCT = Struct(">4sIHHI")
+ENTRY_STRUCT = Struct(">HHBBHIII")
+
 # Hashing algorithm taken from Gamma and LordNed's WArchive-Tools, hope it works
 def hash_name(name):
     hash = 0
@@ -188,29 +291,21 @@ class StringTable(object):
     def size(self):
         return self._strings.tell()#len(self._strings.getvalue())
 
+    def getvalue(self):
+        return self._strings.getvalue()
+
     def write_to(self, f):
         f.write(self._strings.getvalue())
 
-def stringtable_get_name(f, stringtable_offset, offset):
-    current = f.tell()
-    f.seek(stringtable_offset+offset)
-
-    stringlen = 0
-    while f.read(1) != b"\x00":
-        stringlen += 1
+def read_string_offsets(table):
+    # Splits a string table in one go into a dictionary of offset -> encoded string
+    strings = {}
+    offset = 0
+    for string in table.split(b"\x00"):
+        strings[offset] = string
+        offset += len(string) + 1
 
-    f.seek(stringtable_offset+offset)
-
-    filename = f.read(stringlen)
-    try:
-        decodedfilename = filename.decode("shift-jis")
-    except:
-        log.error(f"filename: {filename}")
-        log.error("failed")
-        raise
-    f.seek(current)
-
-    return decodedfilename
+    return strings
 
 def split_path(path): # Splits path at first backslash encountered
     for i, char in enumerate(path):
@@ -223,6 +318,8 @@ def split_path(path): # Splits path at first backslash encountered
     return path, None
 
 class Directory(object):
+    __slots__ = ("files", "subdirs", "name", "_nodeindex", "parent")
+
     def __init__(self, dirname, nodeindex=None):
         self.files = {}
         self.subdirs = {}
@@ -232,7 +329,19 @@ class Directory(object):
         self.parent = None
 
     @classmethod
-    def from_dir(cls, path, follow_symlinks=False):
+    def from_dir(cls, path, follow_symlinks=False, executor=None):
+        # If executor is set (e.g. a ThreadPoolExecutor), the files are read on it while the
+        # rest of the directory tree is scanned.
+        pending = []
+        dir = cls._from_dir(path, follow_symlinks, executor, pending)
+
+        for parent, filename, future in pending:
+            parent.files[filename] = future.result()
+
+        return dir
+
+    @classmethod
+    def _from_dir(cls, path, follow_symlinks, executor, pending):
         dirname = os.path.basename(path)
         log.debug(f"{dirname} {path}")
         dir = cls(dirname)
@@ -241,21 +350,25 @@ class Directory(object):
         for entry in os.scandir(path):
             log.debug(f"{entry.path} {dirname}")
             if entry.is_dir(follow_symlinks=follow_symlinks):
-                newdir = Directory.from_dir(entry.path, follow_symlinks=follow_symlinks)
+                newdir = cls._from_dir(entry.path, follow_symlinks, executor, pending)
                 dir.subdirs[entry.name] = newdir
                 newdir.parent = dir
 
             elif entry.is_file(follow_symlinks=follow_symlinks):
-                with open(entry.path, "rb") as f:
-                    file = File.from_file(entry.name, f)
-                dir.files[entry.name] = file
+                if executor is None:
+                    dir.files[entry.name] = File.from_path(entry.name, entry.path)
+                else:
+                    # The entry is added now so the files keep the order of the directory
+                    dir.files[entry.name] = None
+                    pending.append((dir, entry.name, executor.submit(File.from_path, entry.name, entry.path)))
 
         return dir
 
 
 
     @classmethod
-    def from_node(cls, f, _name, stringtable_offset, globalentryoffset, dataoffset, nodelist, currentnodeindex, parents=None):
+    def from_node(cls, _name, dataoffset, nodelist, entries, currentnodeindex, parents=None, archive_view=None):
+        # nodelist and entries are the node table and the file entries as returned by parse_tables.
         log.debug("=============================")
         log.debug(f"Creating new node with index {currentnodeindex}")
         name, unknown, entrycount, entryoffset = nodelist[currentnodeindex]
@@ -264,35 +377,17 @@ class Directory(object):
 
         newdir = cls(name, currentnodeindex)
 
-        firstentry = globalentryoffset+entryoffset
         log.debug(f"Node {currentnodeindex} {name} {entrycount} {entryoffset}")
-        log.debug(f"offset {f.tell()}")
-        for i in range(entrycount):
-            offset = globalentryoffset + (entryoffset+i)*20
-            f.seek(offset)
-
-            fileentry_data = f.read(20)
-
-            fileid, hashcode, flags, padbyte, nameoffset, filedataoffset, datasize, padding = unpack(">HHBBHIII", fileentry_data)
-            log.debug(f"offset {hex(firstentry+i*20)} {fileid} {flags} {nameoffset}")
-
-            name = stringtable_get_name(f, stringtable_offset, nameoffset)
-
-            log.debug(f"name {name} {fileid}")
+        for name, fileid, hashcode, flags, filedataoffset, datasize in entries[entryoffset:entryoffset+entrycount]:
+            log.debug(f"name {name} {fileid} {flags}")
 
             if name == "." or name == ".." or name == "":
                 continue
-            log.debug(f"{name} {nameoffset}")
 
             if (flags & DIRECTORY) != 0 and not (flags & FILE): #fileid == 0xFFFF: # entry is a sub directory
-                #fileentrydata = f.read(12)
-                #nodeindex, datasize, padding = unpack(">III", fileentrydata)
                 nodeindex = filedataoffset
-
-                name = stringtable_get_name(f, stringtable_offset, nameoffset)
                 log.debug(f"{name} {hashcode} {hash_name(name)}")
 
-
                 newparents = [currentnodeindex]
                 if parents is not None:
                     newparents.extend(parents)
@@ -303,7 +398,8 @@ class Directory(object):
                     log.warning(f"Skipping")
                     continue
 
-                subdir = Directory.from_node(f, name, stringtable_offset, globalentryoffset, dataoffset, nodelist, nodeindex, parents=newparents)
+                subdir = Directory.from_node(name, dataoffset, nodelist, entries, nodeindex, parents=newparents,
+                                             archive_view=archive_view)
                 subdir.parent = newdir
 
                 newdir.subdirs[subdir.name] = subdir
@@ -314,8 +410,7 @@ class Directory(object):
                     log.info("File is compressed")
                 if flags & YAZ0:
                     log.info("File is yaz0 compressed")
-                f.seek(offset)
-                file = File.from_fileentry(f, stringtable_offset, dataoffset, fileid, hashcode, flags, nameoffset, filedataoffset, datasize)
+                file = File.from_fileentry(archive_view, name, dataoffset, fileid, hashcode, flags, filedataoffset, datasize)
                 newdir.files[file.name] = file
 
         return newdir
@@ -353,16 +448,17 @@ class Directory(object):
         name, rest = split_path(path)
 
         if rest is None or rest.strip() == "":
-            if isinstance(name, File):
+            if isinstance(entry, File):
                 if name in self.subdirs:
                     raise FileExistsError("Cannot add file, '{}' already exists as a directory".format(path))
 
                 self.files[name] = entry
-            elif isinstance(name, Directory):
+            elif isinstance(entry, Directory):
                 if name in self.files:
                     raise FileExistsError("Cannot add directory, '{}' already exists as a file".format(path))
 
                 self.subdirs[name] = entry
+                entry.parent = self
             else:
                 raise TypeError("Entry should be of type File or Directory but is type {}".format(type(entry)))
 
@@ -382,17 +478,26 @@ class Directory(object):
         entries.extend(dir.subdirs.keys())
         return entries
 
-    def extract_to(self, path):
-        current_dirpath = os.path.join(path, self.name)
-        os.makedirs(current_dirpath, exist_ok=True)
+    def extract_to(self, path, executor=None):
+        # If executor is set (e.g. a ThreadPoolExecutor), the files are written on it
+        futures = []
+        pending = [(self, path)]
+        while pending:
+            dir, path = pending.pop()
+            current_dirpath = os.path.join(path, dir.name)
+            os.makedirs(current_dirpath, exist_ok=True)
 
-        for filename, file in self.files.items():
-            filepath = os.path.join(current_dirpath, filename)
-            with open(filepath, "w+b") as f:
-                file.dump(f)
+            for filename, file in dir.files.items():
+                filepath = os.path.join(current_dirpath, filename)
+                if executor is None:
+                    file.dump_to(filepath)
+                else:
+                    futures.append(executor.submit(file.dump_to, filepath))
 
-        for dirname, dir in self.subdirs.items():
-            dir.extract_to(current_dirpath)
+            pending.extend((subdir, current_dirpath) for subdir in dir.subdirs.values())
+
+        for future in futures:
+            future.result()
     
     def absolute_path(self):
         name = self.name
@@ -403,89 +508,444 @@ class Directory(object):
         
         return name
 
-class File(BytesIO):
-    def __init__(self, filename, fileid=None, hashcode=None, flags=None):
-        super().__init__()
+class File(object):
+    # A file-like object for the data of a file in an archive.
+    # Files read from an archive start out as a read-only view into the data of the whole
+    # archive. The data is only copied into a bytearray of the file once it is changed
+    # (copy-on-write). Until then _source is the buffer of the archive, _offset and _size the
+    # location of the data in it and _data is None; the view itself is only created when needed.
+    # The digest of the data is only kept while it can't change, i.e. while it's still a view.
+    # The FileListing of filetype is only created when it's used.
+    __slots__ = ("name", "_fileid", "_hashcode", "_flags", "_filetype", "_source", "_offset", "_size", "_data",
+                 "_pos", "_digest")
 
+    def __init__(self, filename, fileid=None, hashcode=None, flags=None):
         self.name = filename
         self._fileid = fileid
         self._hashcode = hashcode
         self._flags = flags
-        if flags is not None:
-            self.filetype = FileListing.from_flags(flags)
-        else:
-            self.filetype = FileListing.default()
+        self._filetype = None
+
+        self._source = None
+        self._offset = 0
+        self._size = 0
+        self._data = bytearray()
+        self._pos = 0
+        self._digest = None
+
+    @property
+    def filetype(self):
+        # The same FileListing is returned every time, so changes to it are kept
+        if self._filetype is None:
+            if self._flags is not None:
+                self._filetype = FileListing.from_flags(self._flags)
+            else:
+                self._filetype = FileListing.default()
+        return self._filetype
+
+    @filetype.setter
+    def filetype(self, filetype):
+        self._filetype = filetype
+
+    def _entry_flags(self):
+        # The flags the file was read with, with the changes made through filetype. Flags that
+        # FileListing doesn't know are kept. None for new files whose filetype wasn't used.
+        if self._filetype is None:
+            return self._flags
+        return ((self._flags or 0) & ~FILELISTING_FLAGS) | self._filetype.flags
+
+    def _materialize(self):
+        if self._source is not None:
+            self._data = bytearray(self._buffer())
+            self._source = None
+            self._digest = None
+
+    def _buffer(self):
+        if self._source is not None:
+            return self._source[self._offset:self._offset+self._size]
+        return self._data
+
+    def getview(self):
+        # Read-only memoryview of the file data that doesn't copy it when possible.
+        if self._source is not None:
+            return self._buffer()
+        return memoryview(bytes(self._data))
+
+    def getvalue(self):
+        return bytes(self._buffer())
+
+    def digest(self):
+        # SHA-256 of the file data, computed once for files that are still a view into an archive
+        if self._source is None:
+            return hashlib.sha256(self._data).digest()
+        if self._digest is None:
+            self._digest = hashlib.sha256(self._buffer()).digest()
+        return self._digest
+
+    def same_data(self, other):
+        # Compares the sizes first, then whether both are the same view, and only then the digests
+        if len(self) != len(other):
+            return False
+        if (self._source is not None and self._source is other._source
+                and self._offset == other._offset):
+            return True
+        return self.digest() == other.digest()
+
+    def getbuffer(self):
+        self._materialize()
+        return memoryview(self._data)
+
+    def __len__(self):
+        if self._source is not None:
+            return self._size
+        return len(self._data)
+
+    def read(self, size=-1):
+        buffer = self._buffer()
+        start = min(self._pos, len(buffer))
+        end = len(buffer) if size is None or size < 0 else min(start + size, len(buffer))
+        self._pos = max(self._pos, end)
+        return bytes(buffer[start:end])
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        buffer = self._buffer()
+        start = min(self._pos, len(buffer))
+        end = bytes(buffer[start:]).find(b"\n")
+        end = len(buffer) if end == -1 else start + end + 1
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        self._pos = max(self._pos, end)
+        return bytes(buffer[start:end])
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += len(self)
+        if pos < 0:
+            raise ValueError("negative seek value {0}".format(pos))
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def write(self, b):
+        self._materialize()
+        with memoryview(b) as view:
+            size = view.nbytes
+            pos = self._pos
+            if pos > len(self._data):
+                self._data.extend(bytes(pos - len(self._data)))
+            self._data[pos:pos+size] = view.cast("B")
+        self._pos = pos + size
+        return size
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def truncate(self, size=None):
+        self._materialize()
+        if size is None:
+            size = self._pos
+        elif size < 0:
+            raise ValueError("negative size value {0}".format(size))
+        del self._data[size:]
+        return size
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        pass
+
     def is_yaz0_compressed(self):
-        if self._flags & COMPRESSED and not self._flags & YAZ0:
+        flags = self._entry_flags()
+        if flags is None:
+            return False
+        if flags & COMPRESSED and not flags & YAZ0:
             log.warning(f"Warning, file {self.name} is compressed but not with yaz0!")
-        return self.filetype.compressed and self.filetype.yaz0
-    
+        return bool(flags & COMPRESSED and flags & YAZ0)
+
     @classmethod
     def from_file(cls, filename, f):
         file = cls(filename)
-
-        file.write(f.read())
-        file.seek(0)
+        file._data = bytearray(f.read())
 
         return file
 
     @classmethod
-    def from_fileentry(cls, f, stringtable_offset, globaldataoffset, fileid, hashcode, flags, nameoffset, filedataoffset, datasize):
-        filename = stringtable_get_name(f, stringtable_offset, nameoffset)
+    def from_path(cls, filename, path):
+        with open(path, "rb") as f:
+            return cls.from_file(filename, f)
+
+    @classmethod
+    def from_fileentry(cls, archive_view, filename, globaldataoffset, fileid, hashcode, flags, filedataoffset, datasize):
         log.debug(f"-----")
-        log.debug(f'"File": {len(filename)}')
+        log.debug(f'"File": {filename}')
         log.debug(f'"size": {datasize}')
-        log.debug(f'{hex(stringtable_offset)} {hex(nameoffset)}')
-        log.debug(f'{hex(datasize)}')
 
         file = cls(filename, fileid, hashcode, flags)
 
-        f.seek(globaldataoffset+filedataoffset)
-        file.write(f.read(datasize))
+        file._source = archive_view
+        file._offset = globaldataoffset+filedataoffset
+        # Like slicing, the size is clipped to the end of a truncated archive
+        file._size = max(0, min(datasize, len(archive_view) - file._offset))
+        file._data = None
         DATA[0] += datasize
-        # Reset file position
-        file.seek(0)
 
         return file
 
     def dump(self, f):
-        if self.is_yaz0_compressed:
-            decompress(self, f, suppress_error=True)
+        # Yaz0-compressed files are decompressed, whether they are flagged as such or not
+        data = self.getview()
+        if data[:4] == b"Yaz0":
+            decompress_to_file(data, f)
         else:
-            f.write(self.getvalue())
+            f.write(data)
+
+    def dump_to(self, path):
+        with open(path, "w+b") as f:
+            self.dump(f)
+
+
+def read_header_data(f):
+    # Reads everything in front of the file data of an archive: The header, the node table,
+    # the file entries and the string table. Yaz0-compressed archives are only decompressed
+    # that far, and f only needs to support read(), e.g. a file opened from a zip file.
+    header = f.read(4)
+
+    if header == b"Yaz0":
+        decoder = Yaz0Decoder(limit=0x20)
+        decoder.feed(header)
+        data = decompress_stream(f, decoder=decoder)
+        if data[:4] != b"RARC":
+            raise RuntimeError("Unknown file header: {} should be RARC".format(bytes(data[:4])))
+
+        decoder.limit = unpack_from(">I", data, 12)[0] + 0x20
+        decoder.feed()
+        data = decompress_stream(f, decoder=decoder)
+    elif header == b"RARC":
+        data = header + f.read(0x1C)
+        data_offset = unpack_from(">I", data, 12)[0] + 0x20
+        data += f.read(data_offset - 0x20)
+    else:
+        raise RuntimeError("Unknown file header: {} should be Yaz0 or RARC".format(header))
+
+    if len(data) < unpack_from(">I", data, 12)[0] + 0x20:
+        raise RuntimeError("Archive header is truncated")
+
+    return data
+
+
+def parse_tables(data):
+    # Decodes the node table, the file entries and the string table of an archive, each with
+    # a single bulk read. data has to contain at least everything in front of the file data.
+    # Returns the data offset, the nodes as (name, hash, entry count, first entry) with only
+    # the name of the root node set, and the entries as (name, fileid, hash, flags, data offset
+    # or node index, data size).
+    header = bytes(data[0:4])
+    if header != b"RARC":
+        raise RuntimeError("Unknown file header: {} should be RARC".format(header))
+
+    data_offset = unpack_from(">I", data, 12)[0] + 0x20
+    node_count, _, _, file_entry_offset, _, stringtable_offset = unpack_from(">IIIIII", data, 0x20)
+    file_entry_offset += 0x20
+    stringtable_offset += 0x20
+
+    if len(data) < data_offset:
+        raise RuntimeError("Archive header is truncated")
+
+    log.debug(f"Archive has {node_count} total directories")
+    log.debug(f"data offset {hex(data_offset)}")
+
+    raw_nodes = list(NODE_STRUCT.iter_unpack(data[0x40:0x40 + node_count*NODE_STRUCT.size]))
+    entry_count = max((entryoffset + entrycount for _, _, _, entrycount, entryoffset in raw_nodes), default=0)
+    raw_entries = ENTRY_STRUCT.iter_unpack(data[file_entry_offset:file_entry_offset + entry_count*ENTRY_STRUCT.size])
+
+    table = bytes(data[stringtable_offset:data_offset])
+    strings = read_string_offsets(table)
+    names = {}
+
+    def get_name(offset):
+        name = names.get(offset)
+        if name is None:
+            string = strings.get(offset)
+            if string is None:
+                # Name that starts in the middle of another string
+                string = table[offset:table.index(b"\x00", offset)]
+            try:
+                name = names[offset] = string.decode("shift-jis")
+            except:
+                log.error(f"filename: {string}")
+                log.error("failed")
+                raise
+
+        return name
+
+    nodes = [(get_name(nameoffset) if i == 0 else None, hashcode, entrycount, entryoffset)
+             for i, (_nodetype, nameoffset, hashcode, entrycount, entryoffset) in enumerate(raw_nodes)]
+    entries = [(get_name(nameoffset), fileid, hashcode, flags, filedataoffset, datasize)
+               for fileid, hashcode, flags, _, nameoffset, filedataoffset, datasize, _ in raw_entries]
+
+    return data_offset, nodes, entries
+
+
+def list_files(f):
+    # Returns (path, fileid, flags, size) for every file in the archive without reading
+    # or decompressing the file data.
+    _, nodes, entries = parse_tables(read_header_data(f))
+
+    files = []
+
+    def walk_node(nodeindex, path, parents):
+        _, _, entrycount, entryoffset = nodes[nodeindex]
+
+        for name, fileid, _, flags, filedataoffset, datasize in entries[entryoffset:entryoffset+entrycount]:
+            if name == "." or name == ".." or name == "":
+                continue
+
+            if (flags & DIRECTORY) != 0 and not (flags & FILE):
+                if filedataoffset in parents or filedataoffset >= len(nodes):
+                    log.warning(f"Detected recursive directory: {name}")
+                    continue
+                walk_node(filedataoffset, path+"/"+name, parents + [filedataoffset])
+            else:
+                files.append((path+"/"+name, fileid, flags, datasize))
+
+    walk_node(0, nodes[0][0], [0])
+
+    return files
+
+
+class ArchiveDiff(object):
+    # Paths of the files and directories that were added, removed or changed, relative to the
+    # root directories of the archives, and the (old, new) names of the root directory if it
+    # was renamed
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.root_renamed = None
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed or self.root_renamed)
+
+    def __str__(self):
+        lines = []
+        if self.root_renamed is not None:
+            lines.append("R {0} -> {1}".format(*self.root_renamed))
+        lines.extend("+ "+path for path in self.added)
+        lines.extend("- "+path for path in self.removed)
+        lines.extend("M "+path for path in self.changed)
+        return "\n".join(lines)
+
+
+def _dir_contents(dir, path):
+    # The paths of a directory and of everything in it
+    paths = []
+    pending = [(dir, path)]
+    while pending:
+        dir, path = pending.pop()
+        paths.append(path)
+        paths.extend(path+"/"+name for name in dir.files)
+        pending.extend((subdir, path+"/"+name) for name, subdir in dir.subdirs.items())
+    return paths
 
 
 class Archive(object):
     def __init__(self):
         self.root = None
+
+        # The buffer of the archive file this archive was read from, for write_arc_in_place
+        self._source = None
+        # The memory map of an archive read with open_mmap, see close
+        self._mapping = None
+
+        # Full path -> entry for every file and directory, and lowercase path -> full path.
+        # It's built on the first lookup. Changes that go through __setitem__, remove and rename
+        # keep it up to date. Other changes to the directory tree are noticed on lookup, see
+        # _is_current and _find.
+        self._index = None
+        self._index_lower = None
+        self._index_root = None
         
     @classmethod
-    def from_dir(cls, path, follow_symlinks=False):
+    def from_dir(cls, path, follow_symlinks=False, executor=None):
         arc = cls()
-        dir = Directory.from_dir(path, follow_symlinks=follow_symlinks)
+        dir = Directory.from_dir(path, follow_symlinks=follow_symlinks, executor=executor)
         arc.root = dir
 
         return arc
 
 
     @classmethod
-    def from_file(cls, f):
-        newarc = cls()
+    def from_file(cls, f, validate_yaz0=False):
+        # With validate_yaz0, Yaz0-compressed archives are checked for errors before they are
+        # decompressed, which is a lot quicker than finding out about them while decompressing.
+        archive_view = None
         header = f.read(4)
 
         if header == b"Yaz0":
             # Decompress first
             log.info("Yaz0 header detected, decompressing...")
             start = time.time()
-            tmp = BytesIO()
             f.seek(0)
-            decompress(f, tmp)
+            data = f.getview() if hasattr(f, "getview") else f.read()
+            if validate_yaz0:
+                stats = validate(data)
+                if not stats.valid:
+                    raise RuntimeError("Corrupted Yaz0 file: {0}".format("; ".join(stats.errors)))
+                for warning in stats.warnings:
+                    log.warning(f"Yaz0 file: {warning}")
+            # The decompressed archive is decoded directly into the buffer of the BytesIO
+            tmp = BytesIO()
+            decompressed_size = read_decompressed_size(data)
+            if decompressed_size > 0:
+                tmp.seek(decompressed_size - 1)
+                tmp.write(b"\x00")
+                with tmp.getbuffer() as out:
+                    decompress_buffer(data, out)
+            del data
+            # Nothing else writes to tmp, so its buffer can be shared with the files directly
+            archive_view = tmp.getbuffer().toreadonly()
             #with open("decompressed.bin", "wb") as g:
             #    decompress(f,)
-            f = tmp
-            f.seek(0)
-
-            header = f.read(4)
+            header = bytes(archive_view[0:4])
             log.info("Finished decompression.")
             log.info(f"Time taken: {time.time() - start}")
 
@@ -494,41 +954,98 @@ class Archive(object):
         else:
             raise RuntimeError("Unknown file header: {} should be Yaz0 or RARC".format(header))
 
-        size = read_uint32(f)
-        f.read(4) #unknown
+        # Files in the archive are views into a single read-only buffer of the whole archive
+        # instead of copies of their data. Archives that are read from an unchanged file of
+        # another archive share that archive's buffer.
+        if archive_view is not None:
+            pass
+        elif hasattr(f, "getview"):
+            # Files of other archives, and files read from an ISO (see gcm.DiscFileData)
+            archive_view = f.getview()
+        elif isinstance(f, BytesIO):
+            # getvalue() usually shares the BytesIO's memory, but unlike getbuffer() it doesn't
+            # keep the caller from resizing it later
+            archive_view = memoryview(f.getvalue())
+        else:
+            f.seek(0)
+            archive_view = memoryview(f.read())
 
-        data_offset = read_uint32(f) + 0x20
-        f.read(16) # Unknown
-        node_count = read_uint32(f)
-        f.read(8) # Unknown
-        file_entry_offset = read_uint32(f) + 0x20
-        f.read(4) # Unknown
-        stringtable_offset = read_uint32(f) + 0x20
-        f.read(8) # Unknown
-        nodes = []
+        return cls.from_buffer(archive_view)
 
-        log.debug(f"Archive has {node_count} total directories")
+    @classmethod
+    def open_mmap(cls, path, validate_yaz0=False):
+        # Reads an archive file through a read-only memory map: the headers are parsed in place
+        # and the files are views into the mapping, so only the parts of the file that are used
+        # are ever read. Yaz0-compressed archives are decompressed from the mapping into memory.
+        # The mapping stays open until close is called, or as long as any file of the archive is
+        # still a view into it.
+        with open(path, "rb") as f:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty file
+                raise RuntimeError("Unknown file header: {} should be Yaz0 or RARC".format(b""))
+
+        data = memoryview(mapping)
+        if bytes(data[0:4]) == b"Yaz0":
+            if validate_yaz0:
+                stats = validate(data)
+                if not stats.valid:
+                    raise RuntimeError("Corrupted Yaz0 file: {0}".format("; ".join(stats.errors)))
+                for warning in stats.warnings:
+                    log.warning(f"Yaz0 file: {warning}")
+            decompressed = decompress_buffer(data)
+            data.release()
+            mapping.close()
+            return cls.from_buffer(memoryview(decompressed).toreadonly())
+
+        newarc = cls.from_buffer(data)
+        newarc._mapping = mapping
+        return newarc
 
-                
-        
-        log.debug(f"data offset {hex(data_offset)}")
-        for i in range(node_count):
-            nodetype = f.read(4)
-            nodedata = f.read(4+2+2+4)
-            nameoffset, unknown, entrycount, entryoffset = unpack(">IHHI", nodedata)
+    @classmethod
+    def from_buffer(cls, data):
+        # Reads an uncompressed archive from a bytes-like object. The files are views into it,
+        # so it shouldn't be changed afterwards.
+        archive_view = memoryview(data)
+        if bytes(archive_view[0:4]) != b"RARC":
+            raise RuntimeError("Unknown file header: {} should be RARC".format(bytes(archive_view[0:4])))
 
-            if i == 0:
-                dir_name = stringtable_get_name(f, stringtable_offset, nameoffset)
-            else:
-                dir_name = None 
-                
-            nodes.append((dir_name, unknown, entrycount, entryoffset))
+        newarc = cls()
+        data_offset, nodes, entries = parse_tables(archive_view)
+        newarc.root = Directory.from_node(nodes[0][0], data_offset, nodes, entries, 0, archive_view=archive_view)
+        newarc._source = archive_view
 
-        rootfoldername = nodes[0][0]
-        newarc.root = Directory.from_node(f, rootfoldername, stringtable_offset, file_entry_offset, data_offset, nodes, 0)
-        
         return newarc
 
+    def close(self):
+        # Releases the buffer the archive was read from, and closes the memory map of an archive
+        # read with open_mmap, which keeps the file from being changed or deleted on Windows. Files
+        # that are still views into the buffer get a copy of their data first, so the archive can
+        # still be used, but it can't be patched in place any more.
+        if self._source is not None:
+            pending = [self.root]
+            while pending:
+                dir = pending.pop()
+                for file in dir.files.values():
+                    if file._source is self._source:
+                        file._materialize()
+                pending.extend(dir.subdirs.values())
+            self._source.release()
+            self._source = None
+
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                # Archives read from files of this archive still refer to the mapping
+                log.warning("Archive file is still in use and stays mapped until it's released")
+            self._mapping = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def listdir(self, path):
         if path == ".":
@@ -540,16 +1057,121 @@ class Archive(object):
             entries.extend(dir.subdirs.keys())
             return entries
 
-    def __getitem__(self, path):
-        dirname, rest = split_path(path)
+    def reindex(self):
+        # Rebuilds the path index from the directory tree
+        self._index = {}
+        self._index_lower = {}
+        self._index_root = self.root
+        if self.root is not None:
+            self._add_to_index(self.root.name, self.root)
+
+    def _add_to_index(self, path, entry):
+        pending = [(path, entry)]
+        while pending:
+            path, entry = pending.pop()
+            self._index[path] = entry
+            self._index_lower.setdefault(path.lower(), path)
+
+            if isinstance(entry, Directory):
+                for name, file in entry.files.items():
+                    filepath = path+"/"+name
+                    self._index[filepath] = file
+                    self._index_lower.setdefault(filepath.lower(), filepath)
+                pending.extend((path+"/"+name, subdir) for name, subdir in entry.subdirs.items())
+
+    def _remove_from_index(self, path):
+        # Removes the entry at path and, for a directory, its contents as they are now. Paths that
+        # were left over from changes that didn't go through the archive are caught on lookup.
+        pending = [(path, self._index.get(path))]
+        while pending:
+            path, entry = pending.pop()
+            if entry is None or self._index.get(path) is not entry:
+                continue
 
-        if rest is None or rest.strip() == "":
-            if dirname != self.root.name:
-                raise FileNotFoundError(f'Unable to find "{path}" in ARC file')
+            del self._index[path]
+            lowerpath = path.lower()
+            if self._index_lower.get(lowerpath) == path:
+                del self._index_lower[lowerpath]
+
+            if isinstance(entry, Directory):
+                pending.extend((path+"/"+name, file) for name, file in entry.files.items())
+                pending.extend((path+"/"+name, subdir) for name, subdir in entry.subdirs.items())
+
+    def _is_current(self, fullpath):
+        # Whether the indexed entry of fullpath is still at that path in the directory tree. Code that
+        # changes the files or subdirs of a directory directly doesn't update the index.
+        entry = self._index[fullpath]
+        names = fullpath.split("/")
+        dir = self.root
+        if names[0] != dir.name:
+            return False
+
+        for name in names[1:-1]:
+            dir = dir.subdirs.get(name)
+            if dir is None:
+                return False
+
+        if len(names) == 1:
+            return entry is dir
+        return dir.subdirs.get(names[-1]) is entry or dir.files.get(names[-1]) is entry
+
+    def _resolve(self, path, reindex_if_missing=False):
+        # Returns the full path of an entry as it is spelled in the archive. Paths that can't
+        # be found as they are are looked up again without regard to case. Entries that moved since
+        # the index was built make it be rebuilt, and so does a missing path with reindex_if_missing.
+        if self._index is None or self._index_root is not self.root:
+            self.reindex()
+
+        path = path.replace("\\", "/").rstrip("/")
+        for retry in (False, True):
+            if path in self._index:
+                fullpath = path
             else:
-                return self.root
-        else:
-            return self.root[rest]
+                fullpath = self._index_lower.get(path.lower())
+
+            if fullpath is None:
+                if not reindex_if_missing or retry:
+                    return None
+            elif self._is_current(fullpath):
+                return fullpath
+            self.reindex()
+
+        return None
+
+    def _find(self, path):
+        # Looks up an entry by walking the directory tree, for entries that were added without
+        # going through the archive. Each name is compared without regard to case if it isn't found
+        # as it is.
+        names = path.replace("\\", "/").rstrip("/").split("/")
+        entry = self.root
+        if names[0] != entry.name and names[0].lower() != entry.name.lower():
+            raise FileNotFoundError(f'Unable to find "{path}" in ARC file')
+
+        for name in names[1:]:
+            if not isinstance(entry, Directory):
+                raise RuntimeError("File", entry.name, "is a directory in path", path, "which should not happen!")
+
+            found = entry.subdirs.get(name, entry.files.get(name))
+            if found is None:
+                lowername = name.lower()
+                for children in (entry.subdirs, entry.files):
+                    for childname, child in children.items():
+                        if childname.lower() == lowername:
+                            found = child
+                            break
+                    if found is not None:
+                        break
+            if found is None:
+                raise FileNotFoundError(f'Unable to find "{path}" in ARC file')
+            entry = found
+
+        return entry
+
+    def __getitem__(self, path):
+        fullpath = self._resolve(path)
+        if fullpath is not None:
+            return self._index[fullpath]
+        return self._find(path)
 
     def __setitem__(self, path, entry):
         dirname, rest = split_path(path)
@@ -559,233 +1181,463 @@ class Archive(object):
                 raise RuntimeError("Cannot have more than one directory in the root.")
             elif isinstance(entry, Directory):
                 self.root = entry
+                self.reindex()
             else:
                 raise TypeError("Root entry should be of type directory but is type '{}'".format(type(entry)))
         else:
-            self.root[rest] = entry
+            parentpath, name = path.replace("\\", "/").rstrip("/").rsplit("/", 1)
+            parent = self[parentpath]
+            if not isinstance(parent, Directory):
+                raise RuntimeError("File", parentpath, "is a directory in path", path, "which should not happen!")
+
+            parentpath = self._resolve(parentpath, reindex_if_missing=True)
+            self._remove_from_index(parentpath+"/"+name)
+            parent[name] = entry
+            self._add_to_index(parentpath+"/"+name, entry)
+
+    def remove(self, path):
+        fullpath = self._resolve(path, reindex_if_missing=True)
+        if fullpath is None:
+            raise FileNotFoundError(f'Unable to find "{path}" in ARC file')
+        if "/" not in fullpath:
+            raise RuntimeError("Cannot remove the root directory.")
+
+        parentpath, name = fullpath.rsplit("/", 1)
+        parent = self._index[parentpath]
+        if name in parent.files:
+            del parent.files[name]
+        else:
+            del parent.subdirs[name]
+
+        self._remove_from_index(fullpath)
+
+    def rename(self, path, newname):
+        # Renames a file or directory. Like removing and adding the entry again, this moves it
+        # to the end of its directory.
+        fullpath = self._resolve(path, reindex_if_missing=True)
+        if fullpath is None:
+            raise FileNotFoundError(f'Unable to find "{path}" in ARC file')
+
+        entry = self._index[fullpath]
+        if "/" not in fullpath:
+            entry.name = newname
+            self.reindex()
+            return
+
+        parentpath, name = fullpath.rsplit("/", 1)
+        parent = self._index[parentpath]
+        newpath = parentpath+"/"+newname
+        if newname != name and (newname in parent.files or newname in parent.subdirs):
+            raise FileExistsError("Cannot rename '{}', '{}' already exists".format(path, newpath))
+
+        if isinstance(entry, Directory):
+            del parent.subdirs[name]
+            parent.subdirs[newname] = entry
+        else:
+            del parent.files[name]
+            parent.files[newname] = entry
+        entry.name = newname
+
+        self._remove_from_index(fullpath)
+        self._add_to_index(newpath, entry)
+
+    def extract_to(self, path, executor=None):
+        self.root.extract_to(path, executor)
+
+    def diff(self, other):
+        # Compares the directory trees of two archives without extracting anything. Files are
+        # changed if their sizes or flags differ, or else if their data differs. The data is
+        # only hashed for files of the same size, and only once for files read from an archive.
+        result = ArchiveDiff()
+        if self.root.name != other.root.name:
+            result.root_renamed = (self.root.name, other.root.name)
+        pending = [(self.root, other.root, "")]
+        while pending:
+            dir, otherdir, path = pending.pop()
+
+            for name, file in dir.files.items():
+                otherfile = otherdir.files.get(name)
+                if otherfile is None:
+                    result.removed.append(path+name)
+                elif ((file._entry_flags() is not None and otherfile._entry_flags() is not None
+                       and file._entry_flags() != otherfile._entry_flags())
+                      or not file.same_data(otherfile)):
+                    result.changed.append(path+name)
+
+            for name in otherdir.files:
+                if name not in dir.files:
+                    result.added.append(path+name)
+
+            for name, subdir in dir.subdirs.items():
+                othersubdir = otherdir.subdirs.get(name)
+                if othersubdir is None:
+                    result.removed.extend(_dir_contents(subdir, path+name))
+                else:
+                    pending.append((subdir, othersubdir, path+name+"/"))
+
+            for name, othersubdir in otherdir.subdirs.items():
+                if name not in dir.subdirs:
+                    result.added.extend(_dir_contents(othersubdir, path+name))
+
+        result.added.sort()
+        result.removed.sort()
+        result.changed.sort()
+        return result
+
+    def _source_layout(self):
+        # Pairs every file with its entry in the archive this archive was read from. Returns a list
+        # of (file, entry index, data offset, size), or None if anything about the directory tree,
+        # the file ids or the flags has changed that a full rewrite would store differently.
+        data_offset, nodes, entries = parse_tables(self._source)
+        if self.root.name != nodes[0][0]:
+            return None
+
+        layout = []
+        pending = [(self.root, 0, [])]
+        while pending:
+            dir, nodeindex, parents = pending.pop()
+            _, _, entrycount, entryoffset = nodes[nodeindex]
+            filenames = []
+            subdirnames = []
+
+            for entryindex in range(entryoffset, entryoffset+entrycount):
+                name, fileid, _, flags, filedataoffset, datasize = entries[entryindex]
+                if name == "." or name == ".." or name == "":
+                    continue
 
-    def extract_to(self, path):
-        self.root.extract_to(path)
+                # Mirrors Directory.from_node
+                if (flags & DIRECTORY) != 0 and not (flags & FILE):
+                    newparents = [nodeindex] + parents
+                    if filedataoffset in newparents:
+                        continue
+                    subdir = dir.subdirs.get(name)
+                    if subdir is None or subdir.name != name:
+                        return None
+                    subdirnames.append(name)
+                    pending.append((subdir, filedataoffset, newparents))
+                else:
+                    file = dir.files.get(name)
+                    if file is None or file.name != name or file._fileid != fileid or file._entry_flags() != flags:
+                        return None
+                    filenames.append(name)
+                    layout.append((file, entryindex, data_offset + filedataoffset, datasize))
+
+            if list(dir.files) != filenames or list(dir.subdirs) != subdirnames:
+                return None
+
+        return layout
+
+    def write_arc_in_place(self, f):
+        # Writes the archive like write_arc_uncompressed, but if it was read from a file and only
+        # the data of files has changed since, the original archive is copied and only the data
+        # and sizes of the changed files are overwritten. That's only possible if the new data
+        # of every changed file fits into the 32 byte aligned space of the old data and isn't
+        # shared with another file, otherwise the archive is rewritten completely. Either way,
+        # files keep the ids and flags they were read with.
+        # Returns True if the archive was patched in place.
+        buffer = self._patch_in_place()
+        if buffer is None:
+            log.debug("Unable to patch archive in place, rewriting it")
+            f.write(self.build_arc(CompressionSetting(), keep_file_entries=True))
+            return False
+
+        f.write(buffer)
+        return True
+
+    def _patch_in_place(self):
+        if self._source is None:
+            return None
+        layout = self._source_layout()
+        if layout is None:
+            return None
+
+        # The space of a file ends at the next 32 byte boundary, or earlier if another file starts
+        # before it (archives written by other tools don't always align their files)
+        starts = sorted(set(start for _, _, start, size in layout if size > 0))
+        next_starts = dict(zip(starts, starts[1:] + [len(self._source)]))
+
+        # Data that is used by several entries can't be overwritten for just one of them
+        shared_starts = set()
+        seen_starts = set()
+        for _, _, start, size in layout:
+            if size > 0:
+                if start in seen_starts:
+                    shared_starts.add(start)
+                seen_starts.add(start)
+
+        changes = []
+        for file, entryindex, start, size in layout:
+            # Files that are still a view of their own data in the source haven't been written to
+            if file._source is self._source and file._offset == start and file._size == size:
+                continue
+
+            slot_size = min((size + 0x1F) & ~0x1F, next_starts.get(start, start) - start, len(self._source) - start)
+            data = file.getview()
+            if len(data) > slot_size or start in shared_starts:
+                return None
+            changes.append((entryindex, start, slot_size, data))
+
+        buffer = bytearray(self._source)
+        file_entry_offset = unpack_from(">I", buffer, 0x2C)[0] + 0x20
+
+        for entryindex, start, slot_size, data in changes:
+            buffer[start:start+len(data)] = data
+            buffer[start+len(data):start+slot_size] = bytes(slot_size - len(data))
+            pack_into(">I", buffer, file_entry_offset + entryindex*ENTRY_STRUCT.size + 12, len(data))
+
+        return buffer
 
     def write_arc_compressed(self, f, compression_settings, filelisting = None, maxindex = 0):
-        temp = BytesIO()
-        self.write_arc(temp, compression_settings, filelisting, maxindex)
-        temp.seek(0)
-        
-        if compression_settings.yaz0_fast:
-            compress_fast(temp, f)
-        elif compression_settings.wszst:
-            data = compression_settings.run_wszst(temp)
-        
-            f.write(data)
+        data = self.build_arc(compression_settings, filelisting, maxindex)
+
+        if compression_settings.yaz0_fast or compression_settings.yaz0 or compression_settings.wszst:
+            f.write(compression_settings.compress(data))
     
     def write_arc_uncompressed(self, f, filelisting=None, maxindex=0):
         self.write_arc(f, CompressionSetting())
         
     def write_arc(self, f, compression_settings, filelisting=None, maxindex=0):
-        
-        stringtable = StringTable()
+        f.write(self.build_arc(compression_settings, filelisting, maxindex))
 
-        nodes = BytesIO()
-        entries = BytesIO()
-        data = BytesIO()
+    def build_arc(self, compression_settings, filelisting=None, maxindex=0, keep_file_entries=False):
+        # Returns the archive as a bytearray. The complete layout is calculated first, then
+        # everything is written into a single preallocated buffer.
+        # With keep_file_entries, files keep the file ids and flags they were read with (see
+        # File._entry_flags), and other files are numbered after the highest of those ids.
+        stringtable = StringTable()
 
-        nodecount = 1
-        entries = 0
+        # Directories in the order of the nodes: depth-first, parents before their subdirectories
+        dirlist = []
+        dirpaths = []
+        pending = [(self.root, self.root.name)]
+        while pending:
+            dir, dirpath = pending.pop()
+            dirlist.append(dir)
+            dirpaths.append(dirpath)
+            pending.extend((subdir, dirpath+"/"+subdir.name) for subdir in reversed(dir.subdirs.values()))
 
         # Set up string table with all directory and file names
         stringtable.write_string(".")
         stringtable.write_string("..")
         stringtable.write_string(self.root.name)
 
-        for dir, subdirnames, filenames in self.root.walk():
-            nodecount += len(subdirnames)
-            entries += len(subdirnames) + len(filenames)
+        for i, dir in enumerate(dirlist):
+            dir._nodeindex = i
 
-            for name in subdirnames:
+            for name in dir.subdirs.keys():
                 stringtable.write_string(name)
 
-            for name in filenames:
+            for name in dir.files.keys():
                 stringtable.write_string(name)
 
-        f.write(b"RARC")
-        f.write(b"FOO ") # placeholder for filesize
-        write_uint32(f, 0x20)  #Unknown but often 0x20?
-        f.write(b"BAR ") # placeholder for data offset
-        f.write(b"\x00"*16) # 4 unknown ints
+        # File entries as [fileid, name, flags, data] for each directory
+        direntries = []
+        if keep_file_entries:
+            maxindex = max((file._fileid + 1 for dir in dirlist for file in dir.files.values()
+                            if file._fileid is not None), default=maxindex)
+        fileid = maxindex
+        default_filemeta = FileListing.default()
+        compress_entries = compression_settings.yaz0_fast or compression_settings.yaz0 or compression_settings.wszst
+        uncompressed_entries = []
 
-        write_uint32(f, nodecount)
-        write_uint32(f, 0x20) # unknown
-        f.write(b"\x00"*4) # 1 unknown ints
+        for dir, dirpath in zip(dirlist, dirpaths):
+            files = []
+
+            for filename, file in dir.files.items():
+                filemeta = default_filemeta
+                flags = None
+                if keep_file_entries:
+                    # The flags are kept as they are, including bits that FileListing doesn't know
+                    flags = file._entry_flags()
+                    if flags is not None:
+                        filemeta = FileListing.from_flags(flags)
+                elif filelisting is not None:
+                    filepath = dirpath+"/"+filename
+                    if filepath in filelisting:
+                        fileid, filemeta = filelisting[filepath]
+                if flags is None:
+                    flags = filemeta.to_flags()
 
-        #aligned_file_entry_offset = (0x20 + 44 + (nodecount*16) + 0x1F) & 0x20
-        #write_uint32(f, aligned_file_entry_offset)  # Offset to file entries aligned to multiples of 0x20
-        write_uint32(f, 0xF0F0F0F0)
+                filedata = file.getview()
+                if keep_file_entries and file._fileid is not None:
+                    files.append([file._fileid, file.name, flags, filedata])
+                else:
+                    files.append([fileid, file.name, flags, filedata])
+                    fileid += 1
 
-        f.write(b"\x00"*4) # 1 unknown int
+                # Files flagged as yaz0 compressed are compressed with the archive's compression
+                # setting if their data isn't compressed already. Without compression they are
+                # stored as-is.
+                if filemeta.is_yaz0 and filemeta.is_compressed and compress_entries and filedata[:4] != b"Yaz0":
+                    uncompressed_entries.append(files[-1])
 
-        #aligned_stringtable_offset = aligned_file_entry_offset + ((entries * 20) + 0x1F) & 0x20
-        #write_uint32(f, aligned_stringtable_offset)
-        write_uint32(f, 0xF0F0F0F0)
+            direntries.append(files)
 
-        f.write(b"\x00"*8) # 2 unknown ints
+        # All flagged files are compressed at once before the layout is calculated
+        if uncompressed_entries:
+            compressed_datas = compression_settings.compress_many([entry[3] for entry in uncompressed_entries])
+            for entry, compressed_data in zip(uncompressed_entries, compressed_datas):
+                entry[3] = compressed_data
 
-        node_offset = f.tell()
+        data_size = sum((len(entry[3]) + 0x1F) & ~0x1F for files in direntries for entry in files)
 
-        first_file_entry_index = 0
+        nodecount = len(dirlist)
+        total_file_entries = sum(len(dir.files) + len(dir.subdirs) + 2 for dir in dirlist)
 
-        dirlist = []
+        file_entry_offset = (0x40 + nodecount*NODE_STRUCT.size + 0x1F) & ~0x1F
+        stringtable_offset = (file_entry_offset + total_file_entries*ENTRY_STRUCT.size + 0x1F) & ~0x1F
+        stringtable_size = (stringtable.size() + 0x1F) & ~0x1F
+        data_offset = stringtable_offset + stringtable_size
+        rarc_size = data_offset + data_size
 
-        #aligned_data_offset = aligned_stringtable_offset + (stringtable.size() + 0x1F) & 0x20
+        buffer = bytearray(rarc_size)
 
-        for i, dirinfo in enumerate(self.root.walk()):
-            dirpath, dirnames, filenames = dirinfo
-            dir = self[dirpath]
-            dir._nodeindex = i
+        HEADER_STRUCT.pack_into(buffer, 0, b"RARC", rarc_size, 0x20, data_offset - 0x20, data_size, data_size, 0, 0)
+        INFO_STRUCT.pack_into(buffer, 0x20, nodecount, 0x20, total_file_entries, file_entry_offset - 0x20,
+                              stringtable_size, stringtable_offset - 0x20, 0, 0)
 
-            dirlist.append(dir)
+        string_offset = stringtable.get_string_offset
+        node_offset = 0x40
+        entry_offset = file_entry_offset
+        first_file_entry_index = 0
+        filedata_offset = 0
 
+        for i, (dir, files) in enumerate(zip(dirlist, direntries)):
             if i == 0:
                 nodetype = b"ROOT"
             else:
                 nodetype = dir.name.upper().encode("shift-jis")[:4]
-                if len(nodetype) < 4:
-                    nodetype = nodetype + (b"\x00"*(4 - len(nodetype)))
-
-            f.write(nodetype)
-            write_uint32(f, stringtable.get_string_offset(dir.name))
-            hash = hash_name(dir.name)
-
-            entrycount = len(dirnames) + len(filenames)
-            write_uint16(f, hash)
-            write_uint16(f, entrycount+2)
-
-            write_uint32(f, first_file_entry_index)
-            first_file_entry_index += entrycount + 2 # Each directory has two special entries being the current and the parent directories
 
-        write_pad32(f)
+            # Each directory has two special entries being the current and the parent directories
+            entrycount = len(files) + len(dir.subdirs) + 2
+            NODE_STRUCT.pack_into(buffer, node_offset, nodetype, string_offset(dir.name), hash_name(dir.name),
+                                  entrycount, first_file_entry_index)
+            node_offset += NODE_STRUCT.size
+            first_file_entry_index += entrycount
 
-        current_file_entry_offset = f.tell()
-        #assert f.tell() == aligned_file_entry_offset
-        fileid = maxindex
-        
-        def key_compare(val):
-            #if filelisting is not None:
-            #    if val[0] in filelisting:
-            #        return filelisting[val[0]][0]
-            return maxindex + 1
-        
-        for dir in dirlist:
-            log.debug(f"Hello {dir.absolute_path()}")
-            abspath = dir.absolute_path()   
-            files = []
-            
-            for filename, file in dir.files.items():
-                files.append((abspath+"/"+filename, file))
-            
-            files.sort(key=key_compare)            
-            
-            
-            for filepath, file in files:
-                filemeta = FileListing.default()
-                if filelisting is not None:
-                    if filepath in filelisting:
-                        fileid, filemeta = filelisting[filepath]
-                        write_uint16(f, fileid)
-                        log.debug(f"found filemeta")
-                    else:
-                        write_uint16(f, fileid)
-                else:
-                    write_uint16(f, fileid)
-                filename = file.name 
-                write_uint16(f, hash_name(filename))
-                log.debug(f"Writing filemeta {str(filemeta)}")
-                write_uint8(f, filemeta.to_flags())
-                write_uint8(f, 0) # padding 
-                #f.write(b"\x11\x00") # Flag for file+padding
-                write_uint16(f, stringtable.get_string_offset(filename))
-
-                filedata_offset = data.tell()
-                write_uint32(f, filedata_offset) # Write file data offset
-                
-                if filemeta.is_yaz0 and filemeta.is_compressed:
-                    log.debug("so far so gud")
-                    if compression_settings.wszst:
-                        log.debug("doing wszst thing")
-                        compressed_data = compression_setting.run_wszst(file)
-                        data.write(compressed_data)
-                    else:
-                        # if file was yaz0 compressed then always yaz0fast compress even if wszst is not set
-                        #yaz0.compress_fast(file, data)
-                        data.write(file.getvalue())
-                else:
-                    data.write(file.getvalue()) # Write file data
-                
-                
-                write_uint32(f, data.tell()-filedata_offset) # Write file size
-                write_pad32(data)
-                write_uint32(f, 0)
+            for fileid, filename, flags, filedata in files:
+                size = len(filedata)
+                ENTRY_STRUCT.pack_into(buffer, entry_offset, fileid, hash_name(filename), flags, 0,
+                                       string_offset(filename), filedata_offset, size, 0)
+                entry_offset += ENTRY_STRUCT.size
 
-                fileid += 1
+                start = data_offset + filedata_offset
+                buffer[start:start+size] = filedata
+                filedata_offset += (size + 0x1F) & ~0x1F
 
             specialdirs = [(".", dir), ("..", dir.parent)]
 
             for subdirname, subdir in chain(specialdirs, dir.subdirs.items()):
-                write_uint16(f, 0xFFFF)
-                write_uint16(f, hash_name(subdirname))
-                f.write(b"\x02\x00") # Flag for directory+padding
-                write_uint16(f, stringtable.get_string_offset(subdirname))
-
                 if subdir is None:
                     child_nodeindex = 0xFFFFFFFF
                 else:
                     child_nodeindex = subdir._nodeindex
-                write_uint32(f, child_nodeindex)
-                write_uint32(f, 0x10)
-                write_uint32(f, 0) # Padding
-
-        write_pad32(f)
-        assert f.tell() % 0x20 == 0
-        current_stringtable_offset = f.tell()
-        stringtable.write_to(f)
-
-        write_pad32(f)
-        stringtablesize = f.tell() - current_stringtable_offset
-
-        current_data_offset = f.tell()
-
-        f.write(data.getvalue())
-
-        rarc_size = f.tell()
-
-        f.seek(4)
-        write_uint32(f, rarc_size)
-        f.seek(12)
-        write_uint32(f, current_data_offset-0x20)
-        write_uint32(f, rarc_size - current_data_offset)
-        write_uint32(f, rarc_size - current_data_offset)
-
-        f.seek(40)
-
-        total_file_entries = first_file_entry_index
-        write_uint32(f, total_file_entries)
-        write_uint32(f, current_file_entry_offset-0x20)
-        write_uint32(f, stringtablesize)
-        write_uint32(f, current_stringtable_offset-0x20)
-
-
-
-
-
+                ENTRY_STRUCT.pack_into(buffer, entry_offset, 0xFFFF, hash_name(subdirname), DIRECTORY, 0,
+                                       string_offset(subdirname), child_nodeindex, 0x10, 0)
+                entry_offset += ENTRY_STRUCT.size
 
+        strings = stringtable.getvalue()
+        buffer[stringtable_offset:stringtable_offset+len(strings)] = strings
 
+        return buffer
 
 
+def default_output_path(inputpath, dir2arc, compressed):
+    path, name = os.path.split(inputpath)
 
+    if dir2arc:
+        if compressed:
+            ending = ".szs"
+        else:
+            ending = ".arc"
+        
+        if inputpath.endswith("_ext"):
+            return inputpath[:-4]
+        else:
+            return inputpath + ending 
+    else:
+        return os.path.join(path, name+"_ext")
 
 
+def load_archive(path):
+    # Reads an archive file, or an extracted archive if path is a directory
+    if os.path.isdir(path):
+        return Archive.from_dir(find_archive_root(path))
+    else:
+        with open(path, "rb") as f:
+            return Archive.from_file(f)
 
 
+def find_archive_root(inputpath):
+    # An extracted archive is a directory with the root directory of the archive as its only
+    # folder, next to the filelisting.txt
+    dirscan = os.scandir(inputpath)
+    inputdir = None 
+    
+    for entry in dirscan:
+        if entry.is_dir():
+            if inputdir is None:
+                inputdir = entry.name
+            else:
+                raise RuntimeError("Directory {0} contains multiple folders! Only one folder should exist.".format(inputpath))
+    
+    if inputdir is None:
+        raise RuntimeError("Directory {0} contains no folders! Exactly one folder should exist.".format(inputpath))
+
+    return os.path.join(inputpath, inputdir)
+
+
+def read_filelisting(inputpath):
+    # Returns the file ids and flags stored in the filelisting.txt of an extracted archive
+    # as {path: (fileid, FileListing)} and the highest file id.
+    filelisting = {}
+    maxindex = 0
+    try: 
+        with open(os.path.join(inputpath, "filelisting.txt"), "r") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#"): continue 
+                result = line.split(" ")
+                if len(result) == 2:
+                    path, fileid = result 
+                    filelisting_meta = FileListing.default()
+                else:
+                    path, fileid, metadata = result 
+                    filelisting_meta = FileListing.from_string(metadata)
+                    log.debug(f"{metadata} {filelisting_meta}")
+                
+                filelisting[path] = (int(fileid), filelisting_meta)
+                if int(fileid) > maxindex:
+                    maxindex = int(fileid)
+    except:
+        log.debug("no filelisting")
+        pass
+
+    return filelisting, maxindex
+
+
+def write_filelisting(archive, outputpath):
+    with open(os.path.join(outputpath, "filelisting.txt"), "w") as f:
+        f.write("# DO NOT TOUCH THIS FILE\n")
+        for dirpath, dirnames, filenames in archive.root.walk():
+            currentdir = archive[dirpath]
+            #for name in dirnames:
+            #    
+            #    dir = currentdir[name]
+            #    f.write(dirpath+"/"+name)
+            #    f.write("\n")
+                
+            for name in filenames:
+                file = currentdir[name]
+                f.write(dirpath+"/"+name)
+                f.write(" ")
+                f.write(str(file._fileid))
+                meta = file.filetype.to_string()
+                log.debug(f"{hex(file._flags)} {file.filetype.to_string()}")
+                if meta:
+                    f.write(" ")
+                    f.write(meta)
+                f.write("\n")
 
 
 if __name__ == "__main__":
@@ -797,11 +1649,30 @@ if __name__ == "__main__":
                         help="Path to the archive file (usually .arc or .szs) to be extracted or the directory to be packed into an archive file.")
     parser.add_argument("--yaz0fast", action="store_true",
                         help="Encode archive as yaz0 when doing directory->.arc/.szs")
+    parser.add_argument("--yaz0", action="store_true",
+                        help="Encode archive as yaz0 with the built-in encoder at the level set by --yaz0_level when doing directory->.arc/.szs")
+    parser.add_argument("--yaz0_level", default=DEFAULT_LEVEL, type=int, choices=range(1, OPTIMAL_LEVEL + 1),
+                        help=("Set the compression level for --yaz0. Possible values are 1..{0} with 1 being the fastest "
+                        "and {0} being the smallest but slowest. Default is {1}.".format(OPTIMAL_LEVEL, DEFAULT_LEVEL)))
+    parser.add_argument("--yaz0_time_budget", default=None, type=float,
+                        help=("Maximum number of seconds spent on the optimal parse of --yaz0_level {0}. Once it runs out, "
+                        "the rest of the archive is compressed with level {1}. Default is {2}, inf for no limit.".format(
+                            OPTIMAL_LEVEL, OPTIMAL_FALLBACK_LEVEL, OPTIMAL_TIME_BUDGET)))
     parser.add_argument("--wszst", action="store_true",
                         help="Use wszst (Wimms SZS tools) for yaz0 compression when doing directory->arc/.szs. wszst needs to be installed separately")
     parser.add_argument("--wszst_comprlevel", default="9",
                         help=("Set the compression level for wszst. Values are the same as in wszst's documentation. "
                         "Possible values are 0..10 with 0 being worst, 9 being the default and best and 10 being ultra and most time consuming."))
+    parser.add_argument("--workers", default=None, type=int,
+                        help=("Number of processes used by --yaz0fast and --yaz0 to compress large archives. "
+                        "Defaults to the number of CPUs."))
+    parser.add_argument("--list", action="store_true",
+                        help="Print the files in the archive with their sizes instead of extracting it.")
+    parser.add_argument("--diff", default=None,
+                        help=("Path to a second archive file or extracted archive. Instead of extracting or packing, "
+                        "print the paths that were added (+), removed (-) or changed (M) in it compared to the input."))
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Always compress instead of reusing compressed data of unchanged archives from earlier runs.")
     parser.add_argument("output", default=None, nargs = '?',
                         help="Output path to which the archive is extracted or a new archive file is written, depending on input.")
 
@@ -813,102 +1684,47 @@ if __name__ == "__main__":
     else:
         dir2arc = False
 
-    compression_setting = CompressionSetting(args.yaz0fast, args.wszst, args.wszst_comprlevel)
+    compression_setting = CompressionSetting(args.yaz0fast, args.wszst, args.wszst_comprlevel, args.yaz0, args.yaz0_level,
+                                             args.workers, None if args.no_cache else CompressionCache(),
+                                             yaz0_time_budget=args.yaz0_time_budget)
     log.debug(f"Use wszst? {args.wszst}")
     
     if args.output is None:
-        path, name = os.path.split(inputpath)
-
-        if dir2arc:
-            if args.yaz0fast:
-                ending = ".szs"
-            else:
-                ending = ".arc"
-            
-            if inputpath.endswith("_ext"):
-                outputpath = inputpath[:-4]
-            else:
-                outputpath = inputpath + ending 
-        else:
-            outputpath = os.path.join(path, name+"_ext")
+        outputpath = default_output_path(inputpath, dir2arc, args.yaz0fast or args.yaz0)
     else:
         outputpath = args.output
 
-    if dir2arc:
-        dirscan = os.scandir(inputpath)
-        inputdir = None 
-        
-        for entry in dirscan:
-            if entry.is_dir():
-                if inputdir is None:
-                    inputdir = entry.name
-                else:
-                    raise RuntimeError("Directory {0} contains multiple folders! Only one folder should exist.".format(inputpath))
-        
-        if inputdir is None:
-            raise RuntimeError("Directory {0} contains no folders! Exactly one folder should exist.".format(inputpath))
-        
+    if args.diff is not None:
+        result = load_archive(inputpath).diff(load_archive(os.path.normpath(args.diff)))
+        if result:
+            print(result)
+        else:
+            print("No differences")
+    elif args.list:
+        with open(inputpath, "rb") as f:
+            for path, fileid, flags, size in list_files(f):
+                print(path, size)
+    elif dir2arc:
         log.debug("Packing directory to archive")
-        archive = Archive.from_dir(os.path.join(inputpath, inputdir))
-        filelisting = {}
-        maxindex = 0
-        try: 
-            with open(os.path.join(inputpath, "filelisting.txt"), "r") as f:
-                for line in f:
-                    line = line.strip()
-                    if line.startswith("#"): continue 
-                    result = line.split(" ")
-                    if len(result) == 2:
-                        path, fileid = result 
-                        filelisting_meta = FileListing.default()
-                    else:
-                        path, fileid, metadata = result 
-                        filelisting_meta = FileListing.from_string(metadata)
-                        log.debug(f"{metadata} {filelisting_meta}")
-                    
-                    filelisting[path] = (int(fileid), filelisting_meta)
-                    if int(fileid) > maxindex:
-                        maxindex = int(fileid)
-        except:
-            log.debug("no filelisting")
-            pass
+        archive = Archive.from_dir(find_archive_root(inputpath))
+        filelisting, maxindex = read_filelisting(inputpath)
         
         log.debug("Directory loaded into memory, writing archive now")
         
         
         
         with open(outputpath, "wb") as f:
-            if args.yaz0fast or args.wszst:
+            if args.yaz0fast or args.yaz0 or args.wszst:
                 archive.write_arc_compressed(f, compression_setting, filelisting, maxindex)
             else:
                 archive.write_arc(f, compression_setting, filelisting, maxindex)
+        compression_setting.close()
         log.debug("Done")
     else:
         log.debug("Extracting archive to directory")
         with open(inputpath, "rb") as f:
             archive = Archive.from_file(f)
         archive.extract_to(outputpath)
-        
-        with open(os.path.join(outputpath, "filelisting.txt"), "w") as f:
-            f.write("# DO NOT TOUCH THIS FILE\n")
-            for dirpath, dirnames, filenames in archive.root.walk():
-                currentdir = archive[dirpath]
-                #for name in dirnames:
-                #    
-                #    dir = currentdir[name]
-                #    f.write(dirpath+"/"+name)
-                #    f.write("\n")
-                    
-                for name in filenames:
-                    file = currentdir[name]
-                    f.write(dirpath+"/"+name)
-                    f.write(" ")
-                    f.write(str(file._fileid))
-                    meta = file.filetype.to_string()
-                    log.debug(f"{hex(file._flags)} {file.filetype.to_string()}")
-                    if meta:
-                        f.write(" ")
-                        f.write(meta)
-                    f.write("\n")
+        write_filelisting(archive, outputpath)
 
 
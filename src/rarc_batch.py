@@ -0,0 +1,244 @@
+"""
+Extracts or packs many RARC archives at once.
+
+Every archive is handled by a separate process, while the files of an archive are read and
+written on a pool of threads. The time spent in each step is printed for every archive:
+
+    python -m src.rarc_batch extract path/to/files path/to/course.szs --output extracted
+    python -m src.rarc_batch pack extracted --yaz0
+"""
+import argparse
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from .compression_cache import CompressionCache
+from .rarc import (Archive, CompressionSetting, default_output_path, find_archive_root, read_filelisting,
+                   write_filelisting)
+from .yaz0 import DEFAULT_LEVEL, OPTIMAL_LEVEL, OPTIMAL_TIME_BUDGET, decompress_buffer
+
+ARCHIVE_EXTENSIONS = ('.arc', '.szs')
+DEFAULT_IO_THREADS = 8
+
+
+def find_archives(paths: list) -> list:
+    # Returns (path, path relative to the input it was found in) for every archive file. Folders
+    # are searched recursively for files with one of the ARCHIVE_EXTENSIONS.
+    archives = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if not os.path.isdir(path):
+            archives.append((path, os.path.basename(path)))
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(ARCHIVE_EXTENSIONS):
+                    filepath = os.path.join(dirpath, filename)
+                    archives.append((filepath, os.path.relpath(filepath, path)))
+
+    return archives
+
+
+def _is_extracted_archive(path: str) -> bool:
+    return path.endswith('_ext') or os.path.isfile(os.path.join(path, 'filelisting.txt'))
+
+
+def find_extracted_archives(paths: list) -> list:
+    # Like find_archives, for folders of extracted archives: folders whose name ends with _ext or
+    # that contain a filelisting.txt.
+    folders = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if _is_extracted_archive(path):
+            folders.append((path, os.path.basename(path)))
+            continue
+
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames.sort()
+            for dirname in list(dirnames):
+                folderpath = os.path.join(dirpath, dirname)
+                if _is_extracted_archive(folderpath):
+                    folders.append((folderpath, os.path.relpath(folderpath, path)))
+                    dirnames.remove(dirname)
+
+    return folders
+
+
+def extract_archive(inputpath: str, outputpath: str, io_threads: int = DEFAULT_IO_THREADS) -> dict:
+    timings = {}
+    start = time.perf_counter()
+
+    with open(inputpath, 'rb') as f:
+        data = f.read()
+    timings['read'] = time.perf_counter() - start
+    size = len(data)
+
+    step = time.perf_counter()
+    if data[:4] == b'Yaz0':
+        data = decompress_buffer(data)
+    timings['decode'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    archive = Archive.from_buffer(memoryview(data).toreadonly())
+    timings['parse'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        archive.extract_to(outputpath, executor)
+    write_filelisting(archive, outputpath)
+    timings['write'] = time.perf_counter() - step
+
+    return {'size': size, 'timings': timings}
+
+
+def pack_archive(inputpath: str, outputpath: str, settings: dict, use_cache: bool = True,
+                 io_threads: int = DEFAULT_IO_THREADS) -> dict:
+    # settings are the arguments of CompressionSetting, which is created in the worker process
+    # together with its cache
+    compression_setting = CompressionSetting(cache=CompressionCache() if use_cache else None, **settings)
+    compressed = compression_setting.yaz0_fast or compression_setting.yaz0 or compression_setting.wszst
+    timings = {}
+    start = time.perf_counter()
+
+    try:
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            archive = Archive.from_dir(find_archive_root(inputpath), executor=executor)
+        filelisting, maxindex = read_filelisting(inputpath)
+        timings['scan'] = time.perf_counter() - start
+
+        step = time.perf_counter()
+        data = archive.build_arc(compression_setting, filelisting, maxindex)
+        timings['pack'] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        if compressed:
+            data = compression_setting.compress(data)
+        timings['compress'] = time.perf_counter() - step
+    finally:
+        compression_setting.close()
+
+    step = time.perf_counter()
+    with open(outputpath, 'wb') as f:
+        f.write(data)
+    timings['write'] = time.perf_counter() - step
+
+    return {'size': len(data), 'timings': timings}
+
+
+def run(mode: str, jobs: list, processes: int, io_threads: int, settings: dict = None, use_cache: bool = True):
+    # jobs are (inputpath, outputpath). Yields (inputpath, result, error) in the order in which
+    # the archives are done.
+    if mode == 'extract':
+        submit_args = [(extract_archive, inputpath, outputpath, io_threads) for inputpath, outputpath in jobs]
+    else:
+        submit_args = [(pack_archive, inputpath, outputpath, settings, use_cache, io_threads)
+                       for inputpath, outputpath in jobs]
+
+    if processes == 1:
+        for func, inputpath, *args in submit_args:
+            try:
+                yield inputpath, func(inputpath, *args), None
+            except Exception as e:  # pylint: disable=broad-except
+                yield inputpath, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(func, inputpath, *args): inputpath for func, inputpath, *args in submit_args}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:  # pylint: disable=broad-except
+                yield futures[future], None, e
+
+
+def format_result(inputpath: str, result: dict) -> str:
+    timings = result['timings']
+    steps = ', '.join(f'{step} {elapsed:.3f}s' for step, elapsed in timings.items())
+    return f'{inputpath}: {result["size"] / 1e6:.2f} MB, {steps}, total {sum(timings.values()):.3f}s'
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Extract or pack many RARC archives in parallel.')
+    parser.add_argument('mode', choices=('extract', 'pack'),
+                        help='extract: archive files to folders, pack: extracted folders to archive files.')
+    parser.add_argument('inputs', nargs='+',
+                        help=('Archive files or extracted folders, or folders that are searched for them. '
+                              'Archive files are recognized by the extensions {0}, extracted folders by a name '
+                              'ending with _ext or a filelisting.txt.'.format(', '.join(ARCHIVE_EXTENSIONS))))
+    parser.add_argument('--output', default=None,
+                        help=('Folder the results are written to, keeping the folder structure of the inputs. '
+                              'By default they are written next to the inputs.'))
+    parser.add_argument('--processes', default=None, type=int,
+                        help='Number of archives handled at the same time. Defaults to the number of CPUs.')
+    parser.add_argument('--io_threads', default=DEFAULT_IO_THREADS, type=int,
+                        help='Number of threads that read or write the files of each archive.')
+    parser.add_argument('--yaz0fast', action='store_true',
+                        help='Encode packed archives as yaz0.')
+    parser.add_argument('--yaz0', action='store_true',
+                        help='Encode packed archives as yaz0 with the built-in encoder at the level set by --yaz0_level.')
+    parser.add_argument('--yaz0_level', default=DEFAULT_LEVEL, type=int, choices=range(1, OPTIMAL_LEVEL + 1),
+                        help=f'Compression level for --yaz0, 1..{OPTIMAL_LEVEL}. Default is {DEFAULT_LEVEL}.')
+    parser.add_argument('--yaz0_time_budget', default=None, type=float,
+                        help=(f'Maximum number of seconds spent on the optimal parse of --yaz0_level {OPTIMAL_LEVEL}. '
+                              f'Default is {OPTIMAL_TIME_BUDGET}, inf for no limit.'))
+    parser.add_argument('--wszst', action='store_true',
+                        help='Use wszst for yaz0 compression of packed archives.')
+    parser.add_argument('--wszst_comprlevel', default='9',
+                        help='Compression level for wszst.')
+    parser.add_argument('--workers', default=1, type=int,
+                        help=('Number of processes used to compress each archive. Defaults to 1, as the archives '
+                              'are already compressed in parallel.'))
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Always compress instead of reusing compressed data of unchanged archives.')
+    args = parser.parse_args(argv)
+
+    compressed = args.yaz0fast or args.yaz0
+    if args.mode == 'extract':
+        found = find_archives(args.inputs)
+    else:
+        found = find_extracted_archives(args.inputs)
+
+    jobs = []
+    for inputpath, relpath in found:
+        outputpath = default_output_path(inputpath, args.mode == 'pack', compressed)
+        if args.output is not None:
+            outputpath = os.path.join(args.output, os.path.dirname(relpath), os.path.basename(outputpath))
+            os.makedirs(os.path.dirname(outputpath), exist_ok=True)
+        jobs.append((inputpath, outputpath))
+
+    settings = {
+        'yaz0_fast': args.yaz0fast,
+        'wszst': args.wszst,
+        'compression_level': args.wszst_comprlevel,
+        'yaz0': args.yaz0,
+        'yaz0_level': args.yaz0_level,
+        'workers': args.workers,
+        'yaz0_time_budget': args.yaz0_time_budget,
+    }
+    processes = args.processes or os.cpu_count() or 1
+    processes = max(1, min(processes, len(jobs)))
+
+    start = time.perf_counter()
+    total_size = 0
+    failed = 0
+    for inputpath, result, error in run(args.mode, jobs, processes, args.io_threads, settings,
+                                                 not args.no_cache):
+        if error is not None:
+            print(f'{inputpath}: failed: {error}', file=sys.stderr)
+            failed += 1
+        else:
+            print(format_result(inputpath, result))
+            total_size += result['size']
+
+    elapsed = time.perf_counter() - start
+    print(f'{len(jobs) - failed} of {len(jobs)} archives, {total_size / 1e6:.2f} MB in {elapsed:.3f}s')
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+A wrapper for wszst (Wiimm's SZS Tools), used as an external Yaz0 encoder.
+
+wszst needs to be installed separately and be available in the PATH, unless another executable is
+passed in.
+"""
+import concurrent.futures
+import os
+import subprocess
+import tempfile
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+WSZST_EXECUTABLE = 'wszst'
+
+
+def _run(args: list[str]) -> bytes:
+    try:
+        return subprocess.run(args,
+                              check=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).stdout
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode('utf-8', errors='replace') if e.stderr else ''
+        raise RuntimeError(f'Command:\n\n{" ".join(e.cmd)}\n\n'
+                           f'Error code: {e.returncode}\n\n'
+                           f'Output:\n\n{stderr}') from e
+
+
+def compress(data, level: str = '9', executable: str = WSZST_EXECUTABLE) -> bytes:
+    """
+    Compresses the data in a single wszst process. The data is passed through temporary files.
+    """
+    with tempfile.TemporaryDirectory(prefix='mkddpatcher_') as tmp_dir:
+        src_filepath = os.path.join(tmp_dir, 'src.arc')
+        dst_filepath = os.path.join(tmp_dir, 'dst.szs')
+        with open(src_filepath, 'wb') as f:
+            f.write(data)
+
+        _run([executable, 'COMPRESS', src_filepath, '--dest', dst_filepath, '--compr', str(level)])
+
+        with open(dst_filepath, 'rb') as f:
+            return f.read()
+
+
+def compress_batch(datas: list, level: str = '9', executable: str = WSZST_EXECUTABLE) -> list[bytes]:
+    """
+    Compresses several inputs with a single wszst process. The inputs are written to a temporary
+    directory and wszst writes the results into a second directory.
+    """
+    with tempfile.TemporaryDirectory(prefix='mkddpatcher_') as tmp_dir:
+        src_dirpath = os.path.join(tmp_dir, 'src')
+        dst_dirpath = os.path.join(tmp_dir, 'dst')
+        os.makedirs(src_dirpath)
+        os.makedirs(dst_dirpath)
+
+        src_filepaths = []
+        for i, data in enumerate(datas):
+            src_filepath = os.path.join(src_dirpath, f'{i}.arc')
+            with open(src_filepath, 'wb') as f:
+                f.write(data)
+            src_filepaths.append(src_filepath)
+
+        _run([executable, 'COMPRESS', *src_filepaths, '--dest', dst_dirpath + os.sep, '--compr',
+              str(level)])
+
+        # wszst may change the extension of the destination files, so they are looked up by stem.
+        dst_filenames = {
+            os.path.splitext(filename)[0]: filename
+            for filename in os.listdir(dst_dirpath)
+        }
+        compressed_datas = []
+        for i in range(len(datas)):
+            if str(i) not in dst_filenames:
+                raise RuntimeError(f'wszst did not write a compressed file for input #{i}')
+            with open(os.path.join(dst_dirpath, dst_filenames[str(i)]), 'rb') as f:
+                compressed_datas.append(f.read())
+
+    return compressed_datas
+
+
+class WszstPool(object):
+    """
+    Runs a limited number of wszst processes in the background. Data passed to `submit()` is
+    collected until `batch_size` inputs are pending, or until `flush()` is called, and then
+    compressed with one process launch.
+
+    The pool can be kept around for many archives; `close()` waits for the running processes.
+    """
+
+    def __init__(self,
+                 level: str = '9',
+                 executable: str = WSZST_EXECUTABLE,
+                 max_workers: int = None,
+                 batch_size: int = 16):
+        self.level = level
+        self.executable = executable
+        self.batch_size = batch_size
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def submit(self, data) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._lock:
+            self._pending.append((bytes(data), future))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+        if batch:
+            self._executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list):
+        try:
+            if len(batch) == 1:
+                results = [compress(batch[0][0], self.level, self.executable)]
+            else:
+                results = compress_batch([data for data, _future in batch], self.level,
+                                         self.executable)
+        except Exception as e:  # pylint: disable=broad-except
+            for _data, future in batch:
+                future.set_exception(e)
+        else:
+            for (_data, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def map(self, datas: list) -> list[bytes]:
+        futures = [self.submit(data) for data in datas]
+        self.flush()
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
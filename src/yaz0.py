@@ -3,14 +3,14 @@
 ## Implementation of a yaz0 decoder/encoder in Python, by Yoshi2
 ## Using the specifications in http://www.amnoid.de/gc/yaz0.txt
 
+import io
 import os
-import re
-import math
-import hashlib
+import mmap
 import logging
 
-from io import BytesIO
-from struct import unpack, pack
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+from struct import unpack, unpack_from, pack
 from timeit import default_timer as time
 #from cStringIO import StringIO
 
@@ -40,6 +40,16 @@ def write_limited(f, data, limit):
 def decompress(f, out, suppress_error=False):
     #if out is None:
     #    out = BytesIO()
+
+    if isinstance(out, (memoryview, bytearray, mmap.mmap)):
+        # Writable buffer that is at least as large as the decompressed size in the header,
+        # e.g. a memory map of the output file, decoded into without an intermediate copy.
+        data = f.read()
+        if suppress_error and data[:4] != b"Yaz0":
+            out[:len(data)] = data
+            return
+        decompress_buffer(data, out)
+        return
     
     # A way to discover the total size of the input data that
     # should be compatible with most file-like objects.
@@ -137,27 +147,841 @@ def decompress(f, out, suppress_error=False):
                     f"{out.tell()}/decompressed: {decompressed_size}")
 
 
-def compress_fast(f, out):
-    data = f.read()
-    
+def read_decompressed_size(data):
+    header = bytes(data[0:4])
+    if header != b"Yaz0":
+        raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(header))
+
+    return unpack_from(">I", data, 4)[0]
+
+
+def decompress_buffer(data, out=None):
+    # Second decoder that works on a bytes-like object (bytes, bytearray, memoryview, mmap)
+    # instead of file objects. The output is a bytearray that is allocated up front
+    # from the size stored in the header and back-references are copied with slices.
+    # Output is identical to decompress() except that it never goes past the
+    # decompressed size stored in the header.
+    # Instead of a new bytearray, out can be any writable buffer with at least that size,
+    # like a memoryview or a memory map of the output file.
+    decompressed_size = read_decompressed_size(data)
+    if out is None:
+        out = bytearray(decompressed_size)
+    elif len(out) < decompressed_size:
+        raise RuntimeError("Output buffer is too small: {0} bytes, decompressed size is {1}".format(
+                           len(out), decompressed_size))
+
     maxsize = len(data)
-    
-    out.write(b"Yaz0")
-    out.write(pack(">I", maxsize))
-    out.write(b"\x00"*8)
+    src = 16
+    dst = 0
 
-    out_write = out.write
-    log.info(f"size: {hex(maxsize)}")
-    log.info(maxsize//8, maxsize/8.0)
-    for i in range(int(math.ceil(maxsize/8))):
-        start = i*8 
-        end = (i+1)*8
-        if end > maxsize:
-            # Pad data with 0's up to 8 bytes
-            tocopy = data[start:maxsize] + b"\x00"*(end-maxsize)
-            log.info("Padded")
+    while dst < decompressed_size and src < maxsize:
+        code_byte = data[src]
+        src += 1
+
+        if code_byte == 0xFF and dst + 8 <= decompressed_size and src + 8 <= maxsize:
+            # Fast path: 8 bytes that are copied as-is
+            out[dst:dst+8] = data[src:src+8]
+            dst += 8
+            src += 8
+            continue
+
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if dst >= decompressed_size:
+                break
+
+            if code_byte & bit:
+                if src >= maxsize:
+                    break
+                out[dst] = data[src]
+                dst += 1
+                src += 1
+            else:
+                if src >= maxsize-1:
+                    src = maxsize
+                    break
+
+                infobyte = data[src] << 8 | data[src+1]
+                src += 2
+
+                bytecount = infobyte >> 12
+                if bytecount == 0:
+                    if src >= maxsize:
+                        break
+                    bytecount = data[src] + 0x12
+                    src += 1
+                else:
+                    bytecount += 2
+
+                seekback = dst - ((infobyte & 0x0FFF) + 1)
+                if seekback < 0:
+                    raise RuntimeError("Malformed Yaz0 file: Seek back position goes below 0")
+
+                end = dst + bytecount
+                if end > decompressed_size:
+                    end = decompressed_size
+
+                if end - dst <= dst - seekback:
+                    out[dst:end] = out[seekback:seekback + end - dst]
+                    dst = end
+                else:
+                    # Copy source and copy destination overlap, so the source is repeated.
+                    # Every copy doubles the size of the repeated block we can copy from.
+                    while dst < end:
+                        chunk = min(dst - seekback, end - dst)
+                        out[dst:dst+chunk] = out[seekback:seekback+chunk]
+                        dst += chunk
+
+    if dst < decompressed_size:
+        log.debug("this isn't right")
+        raise RuntimeError("Didn't decompress correctly, notify the developer!")
+
+    return out
+
+
+def decompress_to_file(data, f):
+    # Decompresses data to the current position of the file f. If f is a file on disk, the
+    # file is resized to fit the decompressed data and the data is decoded into a memory map
+    # of the file, so the decompressed data never has to be held in memory as a whole.
+    # f has to be opened for reading and writing for this ("w+b" or "r+b").
+    decompressed_size = read_decompressed_size(data)
+
+    try:
+        fileno = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fileno = None
+
+    if fileno is None or decompressed_size == 0:
+        f.write(decompress_buffer(data))
+        return
+
+    f.flush()
+    start = f.tell()
+    # Memory maps have to start at a multiple of the allocation granularity
+    offset = start - start % mmap.ALLOCATIONGRANULARITY
+    end = start + decompressed_size
+    if os.fstat(fileno).st_size < end:
+        f.truncate(end)
+
+    try:
+        target = mmap.mmap(fileno, end - offset, offset=offset)
+    except (OSError, ValueError) as e:
+        log.debug(f"Unable to memory map output file, writing decompressed data instead: {e}")
+        f.write(decompress_buffer(data))
+        return
+
+    with target, memoryview(target) as view, view[start-offset:] as out:
+        decompress_buffer(data, out)
+
+    f.seek(end)
+
+
+class Yaz0Stats(object):
+    # Result of validate(). match_lengths counts the matches of each length (index 3 to 273),
+    # distance_buckets counts the matches per distance range: bucket 0 is distance 1,
+    # bucket n covers the distances 2**(n-1)+1 to 2**n, up to bucket 12 (2049 to 4096).
+    def __init__(self, compressed_size, decompressed_size):
+        self.compressed_size = compressed_size
+        self.decompressed_size = decompressed_size
+        self.literal_count = 0
+        self.match_count = 0
+        self.match_lengths = [0]*(MAX_MATCH + 1)
+        self.distance_buckets = [0]*13
+        # Bytes after the last token. Zero bytes are accepted as padding.
+        self.trailing_bytes = 0
+        self.errors = []
+        # Problems that both decoders tolerate, so the data can still be decompressed
+        self.warnings = []
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def as_dict(self):
+        return {
+            "compressed_size": self.compressed_size,
+            "decompressed_size": self.decompressed_size,
+            "literal_count": self.literal_count,
+            "match_count": self.match_count,
+            "match_lengths": {length: count for length, count in enumerate(self.match_lengths) if count},
+            "distance_buckets": {
+                "{0}-{1}".format((1 << (i - 1)) + 1 if i else 1, 1 << i): count
+                for i, count in enumerate(self.distance_buckets)
+            },
+            "trailing_bytes": self.trailing_bytes,
+            "errors": self.errors,
+            "warnings": self.warnings,
+        }
+
+
+def validate(data):
+    # Checks a Yaz0 stream without decompressing it: only the output position is tracked, so
+    # every back-reference can be checked against the data that would be output before it.
+    # Problems are collected in the errors of the returned Yaz0Stats instead of raising, and
+    # the check stops at the first broken token. A last back-reference that goes past the
+    # decompressed size and trailing data are only warnings, as the decoders cut them off.
+    header = bytes(data[0:4])
+    if len(data) < 16 or header != b"Yaz0":
+        stats = Yaz0Stats(len(data), 0)
+        stats.errors.append("Not a Yaz0 file, header: {0}".format(header))
+        return stats
+
+    decompressed_size = unpack_from(">I", data, 4)[0]
+    stats = Yaz0Stats(len(data), decompressed_size)
+    match_lengths = stats.match_lengths
+    distance_buckets = stats.distance_buckets
+    errors = stats.errors
+
+    maxsize = len(data)
+    src = 16
+    dst = 0
+    literal_count = 0
+    match_count = 0
+
+    while dst < decompressed_size:
+        if src >= maxsize:
+            errors.append("Data ends at output offset {0:#x}, {1:#x} bytes are missing".format(
+                          dst, decompressed_size - dst))
+            break
+
+        code_byte = data[src]
+        src += 1
+
+        if code_byte == 0xFF and dst + 8 <= decompressed_size and src + 8 <= maxsize:
+            literal_count += 8
+            dst += 8
+            src += 8
+            continue
+
+        for bit in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+            if dst >= decompressed_size:
+                break
+
+            if code_byte & bit:
+                if src >= maxsize:
+                    break
+                literal_count += 1
+                dst += 1
+                src += 1
+            else:
+                # A token that is cut off is reported as missing data by the outer loop
+                if src + 1 >= maxsize:
+                    src = maxsize
+                    break
+
+                infobyte = data[src] << 8 | data[src+1]
+                src += 2
+
+                bytecount = infobyte >> 12
+                if bytecount == 0:
+                    if src >= maxsize:
+                        break
+                    bytecount = data[src] + 0x12
+                    src += 1
+                else:
+                    bytecount += 2
+
+                distance = (infobyte & 0x0FFF) + 1
+                if distance > dst:
+                    errors.append("Back-reference at output offset {0:#x} reaches {1:#x} bytes back".format(
+                                  dst, distance))
+                    break
+                if dst + bytecount > decompressed_size:
+                    stats.warnings.append("Back-reference at output offset {0:#x} goes {1:#x} bytes past the "
+                                          "decompressed size".format(dst, dst + bytecount - decompressed_size))
+
+                match_count += 1
+                match_lengths[bytecount] += 1
+                distance_buckets[(distance - 1).bit_length()] += 1
+                dst = min(dst + bytecount, decompressed_size)
+
+        if errors:
+            break
+
+    stats.literal_count = literal_count
+    stats.match_count = match_count
+
+    if not errors:
+        stats.trailing_bytes = maxsize - src
+        if stats.trailing_bytes and any(data[src:]):
+            stats.warnings.append("{0:#x} bytes of trailing data after the end of the stream".format(
+                                  stats.trailing_bytes))
+
+    return stats
+
+
+class Yaz0Decoder(object):
+    # Incremental decoder: compressed data is passed in with feed() in chunks of any
+    # size, so the input doesn't need to be seekable or read completely. If a limit is
+    # set, decoding stops once that many bytes are decompressed. The limit can be raised
+    # later and decoding continues with the next call to feed().
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.decompressed_size = None
+        self.output = bytearray()
+
+        self._input = bytearray()
+        self._pos = 0
+        self._code_byte = 0
+        self._bits_left = 0
+
+    def target_size(self):
+        if self.decompressed_size is None:
+            return None
+        if self.limit is None:
+            return self.decompressed_size
+        return min(self.limit, self.decompressed_size)
+
+    def finished(self):
+        target = self.target_size()
+        return target is not None and len(self.output) >= target
+
+    def feed(self, data=b""):
+        self._input += data
+
+        if self.decompressed_size is None:
+            if len(self._input) < 16:
+                return
+            header = bytes(self._input[0:4])
+            if header != b"Yaz0":
+                raise RuntimeError("File is not Yaz0-compressed! Header: {0}".format(header))
+            self.decompressed_size = unpack_from(">I", self._input, 4)[0]
+            self._pos = 16
+
+        self._decode()
+
+        # Drop the input that has been decoded already
+        del self._input[:self._pos]
+        self._pos = 0
+
+    def _decode(self):
+        target = self.target_size()
+        data = self._input
+        out = self.output
+        src = self._pos
+        maxsize = len(data)
+        code_byte = self._code_byte
+        bits_left = self._bits_left
+        dst = len(out)
+
+        while dst < target:
+            if bits_left == 0:
+                if src >= maxsize:
+                    break
+                code_byte = data[src]
+                src += 1
+                bits_left = 8
+
+                if code_byte == 0xFF and src + 8 <= maxsize and dst + 8 <= self.decompressed_size:
+                    out += data[src:src+8]
+                    src += 8
+                    dst += 8
+                    bits_left = 0
+                    continue
+
+            if code_byte & 0x80:
+                if src >= maxsize:
+                    break
+                out.append(data[src])
+                src += 1
+                dst += 1
+            else:
+                if src + 1 >= maxsize:
+                    break
+                bytecount = data[src] >> 4
+                if bytecount == 0:
+                    if src + 2 >= maxsize:
+                        break
+                    bytecount = data[src+2] + 0x12
+                    tokensize = 3
+                else:
+                    bytecount += 2
+                    tokensize = 2
+
+                seekback = dst - (((data[src] & 0x0F) << 8 | data[src+1]) + 1)
+                if seekback < 0:
+                    raise RuntimeError("Malformed Yaz0 file: Seek back position goes below 0")
+                src += tokensize
+
+                if bytecount > self.decompressed_size - dst:
+                    bytecount = self.decompressed_size - dst
+
+                # The output grows with every copy, so overlapping copies repeat the source
+                while bytecount > 0:
+                    chunk = min(dst - seekback, bytecount)
+                    out += out[seekback:seekback+chunk]
+                    dst += chunk
+                    bytecount -= chunk
+
+            code_byte = (code_byte << 1) & 0xFF
+            bits_left -= 1
+
+        self._pos = src
+        self._code_byte = code_byte
+        self._bits_left = bits_left
+
+    def getvalue(self):
+        # Returns the decompressed data, cut to the limit if one is set
+        target = self.target_size()
+        if target is None or len(self.output) < target:
+            raise RuntimeError("Didn't decompress correctly, notify the developer!")
+        if len(self.output) > target:
+            return self.output[:target]
+        return self.output
+
+
+def decompress_stream(f, limit=None, chunk_size=0x10000, decoder=None):
+    # Decompresses a Yaz0 stream from a file-like object that only needs to support
+    # read(). With a limit, reading stops as soon as the first limit bytes are decompressed.
+    # Instead of a limit, a decoder can be passed to continue with, e.g. after raising its limit.
+    if decoder is None:
+        decoder = Yaz0Decoder(limit)
+    while not decoder.finished():
+        data = f.read(chunk_size)
+        if not data:
+            break
+        decoder.feed(data)
+
+    return decoder.getvalue()
+
+
+WINDOW_SIZE = 0x1000
+MIN_MATCH = 3
+MAX_MATCH = 0xFF + 0x12
+
+# Settings of the built-in encoder for each compression level:
+# (maximum hash chain length, lazy matching, nice match length, maximum match length
+# up to which every position inside a match is added to the hash chains)
+# Low levels take the first good match they find, high levels search the whole
+# window and check whether starting the match one byte later gives a longer match.
+COMPRESSION_LEVELS = {
+    1: (1, False, 18, 8),
+    2: (4, False, 32, 16),
+    3: (8, False, 64, 32),
+    4: (16, True, 32, 273),
+    5: (32, True, 64, 273),
+    6: (64, True, 128, 273),
+    7: (256, True, 273, 273),
+    8: (1024, True, 273, 273),
+    9: (4096, True, 273, 273),
+}
+DEFAULT_LEVEL = 6
+
+# Level 10 doesn't pick matches greedily but searches for the sequence of literals and
+# back-references with the smallest output size, see _encode_tokens_optimal.
+OPTIMAL_LEVEL = 10
+# (maximum hash chain length, nice match length) of the match search for the optimal parse
+OPTIMAL_SEARCH = (4096, MAX_MATCH)
+# The optimal parse is done for blocks of this many bytes at a time
+OPTIMAL_BLOCK_SIZE = 0x4000
+# Seconds the optimal parse may take when no time budget is passed. The search for the longest
+# match at every position is slow, a few seconds per 100 KB. Pass float("inf") for no limit.
+OPTIMAL_TIME_BUDGET = 10.0
+# Level used for the rest of the data once the time budget of the optimal parse runs out
+OPTIMAL_FALLBACK_LEVEL = 9
+
+# Size of the segments that compress_parallel splits inputs into. It doesn't depend on the number
+# of workers, so neither does the output.
+PARALLEL_SEGMENT_SIZE = 256*1024
+
+
+def _encode_tokens(data, start, end, level, time_budget=None):
+    # Encodes data[start:end] into Yaz0 tokens. Back-references may point up to
+    # WINDOW_SIZE bytes before start, so the data before start has to be output
+    # by the decoder before these tokens.
+    # Tokens are returned as three byte strings: one flag per token (b"1" for a literal,
+    # b"0" for a back-reference), the size of each token and the token data.
+    # They are grouped under code bytes by _pack_tokens.
+    if level == OPTIMAL_LEVEL:
+        return _encode_tokens_optimal(data, start, end, time_budget)
+    if level not in COMPRESSION_LEVELS:
+        raise ValueError("Unknown compression level: {0}".format(level))
+    max_chain, lazy, nice_length, max_insert = COMPRESSION_LEVELS[level]
+
+    flags = bytearray()
+    sizes = bytearray()
+    body = bytearray()
+
+    # Positions from which 3 bytes can be read to look up the hash chains
+    last_key = len(data) - 2
+    head = {}
+    head_get = head.get
+    # Previous position with the same 3 bytes. A window sized ring buffer is enough
+    # because positions further back can't be referenced anyway.
+    prev = [-1]*WINDOW_SIZE
+
+    def find_match(i):
+        limit = end - i
+        if limit > MAX_MATCH:
+            limit = MAX_MATCH
+        elif limit < MIN_MATCH:
+            return 0, 0
+
+        pos = head_get(data[i:i+3], -1)
+        # Also stops at the -1 that marks the end of a chain, which is inside the window
+        # for the first WINDOW_SIZE positions
+        lowest = max(0, i - WINDOW_SIZE)
+        best_length = MIN_MATCH - 1
+        best_pos = -1
+        chain = max_chain
+
+        while pos >= lowest and chain:
+            # Cheap check whether this candidate can beat the best match so far
+            if data[pos+best_length] == data[i+best_length]:
+                length = MIN_MATCH
+                while length + 16 <= limit and data[pos+length:pos+length+16] == data[i+length:i+length+16]:
+                    length += 16
+                while length < limit and data[pos+length] == data[i+length]:
+                    length += 1
+
+                if length > best_length:
+                    best_length = length
+                    best_pos = pos
+                    if length >= nice_length or length == limit:
+                        break
+
+            pos = prev[pos & 0xFFF]
+            chain -= 1
+
+        if best_pos == -1:
+            return 0, 0
+        return best_length, i - best_pos
+
+    # Positions before the start are in the window and can be referenced
+    inserted = max(0, start - WINDOW_SIZE)
+    i = start
+
+    while i < end:
+        if inserted < i:
+            for pos in range(inserted, min(i, last_key)):
+                key = data[pos:pos+3]
+                prev[pos & 0xFFF] = head_get(key, -1)
+                head[key] = pos
+            inserted = i
+
+        length, distance = find_match(i)
+
+        if lazy:
+            while MIN_MATCH <= length < nice_length and i + 1 < end:
+                if inserted == i:
+                    key = data[i:i+3]
+                    prev[i & 0xFFF] = head_get(key, -1)
+                    head[key] = i
+                    inserted = i + 1
+
+                next_length, next_distance = find_match(i+1)
+                if next_length <= length:
+                    break
+
+                # Starting one byte later gives a longer match, emit a literal instead
+                flags.append(0x31)
+                sizes.append(1)
+                body.append(data[i])
+                i += 1
+                length, distance = next_length, next_distance
+
+        if length >= MIN_MATCH:
+            distance -= 1
+            flags.append(0x30)
+            if length >= 0x12:
+                sizes.append(3)
+                body.extend((distance >> 8, distance & 0xFF, length - 0x12))
+            else:
+                sizes.append(2)
+                body.extend((((length - 2) << 4) | (distance >> 8), distance & 0xFF))
+
+            if length > max_insert and inserted == i:
+                # Only the start of long matches is added to the hash chains
+                key = data[i:i+3]
+                prev[i & 0xFFF] = head_get(key, -1)
+                head[key] = i
+                inserted = i + length
+            i += length
         else:
-            tocopy = data[start:end]
-        
-        out_write(b"\xFF") # Set all bits in the code byte to 1 to mark the following 8 bytes as copy
-        out_write(tocopy)
+            flags.append(0x31)
+            sizes.append(1)
+            body.append(data[i])
+            i += 1
+
+    return flags, sizes, body
+
+
+def _encode_tokens_optimal(data, start, end, time_budget=None):
+    # Optimal parse: in bits, a literal costs 9 (flag + byte), a back-reference of 3 to 17 bytes
+    # costs 17 and one of 18 to 273 bytes costs 25. Since the cost doesn't depend on the distance,
+    # the longest match at each position is enough to know every match length that is possible
+    # there. The cheapest encoding of every suffix of a block is then calculated from the back.
+    # If time_budget (in seconds, OPTIMAL_TIME_BUDGET by default) runs out, the remaining blocks
+    # are encoded with OPTIMAL_FALLBACK_LEVEL instead.
+    if time_budget is None:
+        time_budget = OPTIMAL_TIME_BUDGET
+    max_chain, nice_length = OPTIMAL_SEARCH
+    started = time()
+
+    flags = bytearray()
+    sizes = bytearray()
+    body = bytearray()
+
+    last_key = len(data) - 2
+    head = {}
+    head_get = head.get
+    prev = [-1]*WINDOW_SIZE
+
+    for pos in range(max(0, start - WINDOW_SIZE), min(start, last_key)):
+        key = data[pos:pos+3]
+        prev[pos & 0xFFF] = head_get(key, -1)
+        head[key] = pos
+
+    block_start = start
+    while block_start < end:
+        if time() - started > time_budget:
+            log.debug("Time budget of the optimal parse ran out at {0:#x}".format(block_start))
+            rest_flags, rest_sizes, rest_body = _encode_tokens(data, block_start, end, OPTIMAL_FALLBACK_LEVEL)
+            flags += rest_flags
+            sizes += rest_sizes
+            body += rest_body
+            break
+
+        block_end = min(block_start + OPTIMAL_BLOCK_SIZE, end)
+        block_length = block_end - block_start
+        lengths = [0]*block_length
+        distances = [0]*block_length
+
+        # Longest match at every position of the block. Matches don't cross the end of the block.
+        skip_until = block_start
+        for i in range(block_start, block_end):
+            if i < skip_until:
+                # Inside a long match, the rest of that match is used instead of searching again
+                k = i - block_start
+                lengths[k] = lengths[k-1] - 1
+                distances[k] = distances[k-1]
+            else:
+                limit = block_end - i
+                if limit > MAX_MATCH:
+                    limit = MAX_MATCH
+
+                if limit >= MIN_MATCH:
+                    pos = head_get(data[i:i+3], -1)
+                    lowest = max(0, i - WINDOW_SIZE)
+                    best_length = MIN_MATCH - 1
+                    best_pos = -1
+                    chain = max_chain
+
+                    while pos >= lowest and chain:
+                        if data[pos+best_length] == data[i+best_length]:
+                            length = MIN_MATCH
+                            while length + 16 <= limit and data[pos+length:pos+length+16] == data[i+length:i+length+16]:
+                                length += 16
+                            while length < limit and data[pos+length] == data[i+length]:
+                                length += 1
+
+                            if length > best_length:
+                                best_length = length
+                                best_pos = pos
+                                if length >= nice_length or length == limit:
+                                    break
+
+                        pos = prev[pos & 0xFFF]
+                        chain -= 1
+
+                    if best_pos != -1:
+                        lengths[i - block_start] = best_length
+                        distances[i - block_start] = i - best_pos
+                        if best_length >= nice_length:
+                            skip_until = i + best_length
+
+            if i < last_key:
+                key = data[i:i+3]
+                prev[i & 0xFFF] = head_get(key, -1)
+                head[key] = i
+
+        # cost[k] is the size in bits of the cheapest encoding of data[block_start+k:block_end],
+        # choice[k] the length of the first token of it (1 for a literal).
+        cost = [0]*(block_length + 1)
+        choice = [1]*block_length
+        for k in range(block_length - 1, -1, -1):
+            best_cost = cost[k+1] + 9
+            best_choice = 1
+            length = lengths[k]
+
+            if length >= MIN_MATCH:
+                candidates = cost[k+MIN_MATCH:k+min(length, 0x11)+1]
+                candidate_cost = min(candidates)
+                if candidate_cost + 17 < best_cost:
+                    best_cost = candidate_cost + 17
+                    best_choice = candidates.index(candidate_cost) + MIN_MATCH
+
+                if length >= 0x12:
+                    candidates = cost[k+0x12:k+length+1]
+                    candidate_cost = min(candidates)
+                    if candidate_cost + 25 < best_cost:
+                        best_cost = candidate_cost + 25
+                        best_choice = candidates.index(candidate_cost) + 0x12
+
+            cost[k] = best_cost
+            choice[k] = best_choice
+
+        k = 0
+        while k < block_length:
+            length = choice[k]
+            if length == 1:
+                flags.append(0x31)
+                sizes.append(1)
+                body.append(data[block_start + k])
+            else:
+                distance = distances[k] - 1
+                flags.append(0x30)
+                if length >= 0x12:
+                    sizes.append(3)
+                    body.extend((distance >> 8, distance & 0xFF, length - 0x12))
+                else:
+                    sizes.append(2)
+                    body.extend((((length - 2) << 4) | (distance >> 8), distance & 0xFF))
+            k += length
+
+        block_start = block_end
+
+    return flags, sizes, body
+
+
+def _pack_tokens(flags, sizes, body, decompressed_size):
+    out = bytearray(b"Yaz0")
+    out += pack(">I", decompressed_size)
+    out += b"\x00"*8
+
+    offsets = list(accumulate(sizes, initial=0))
+    tokencount = len(flags)
+
+    for i in range(0, tokencount, 8):
+        j = min(i + 8, tokencount)
+        out.append(int(flags[i:j].ljust(8, b"0"), 2))
+        out += body[offsets[i]:offsets[j]]
+
+    return out
+
+
+def compress_buffer(data, level=DEFAULT_LEVEL, time_budget=None):
+    data = bytes(data)
+    flags, sizes, body = _encode_tokens(data, 0, len(data), level, time_budget)
+
+    return _pack_tokens(flags, sizes, body, len(data))
+
+
+def _encode_segment(args):
+    data, start, end, level, time_budget = args
+    return _encode_tokens(data, start, end, level, time_budget)
+
+
+def compress_parallel(data, workers=None, level=DEFAULT_LEVEL, time_budget=None):
+    # Splits the data into segments of PARALLEL_SEGMENT_SIZE bytes and encodes them in separate
+    # processes. Every worker also gets the WINDOW_SIZE bytes before its segment so
+    # back-references can reach into the previous segment, which the decoder will
+    # have output already. The tokens are then grouped under code bytes as one stream.
+    # With one worker, the segments are encoded one after another, which gives the same output.
+    data = bytes(data)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if len(data) <= PARALLEL_SEGMENT_SIZE:
+        return compress_buffer(data, level, time_budget)
+
+    segments = []
+    for start in range(0, len(data), PARALLEL_SEGMENT_SIZE):
+        window_start = max(0, start - WINDOW_SIZE)
+        end = min(start + PARALLEL_SEGMENT_SIZE, len(data))
+        segments.append((data[window_start:end], start - window_start, end - window_start, level,
+                         time_budget))
+
+    flags = bytearray()
+    sizes = bytearray()
+    body = bytearray()
+
+    if workers <= 1:
+        encoded_segments = list(map(_encode_segment, segments))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(segments))) as executor:
+            encoded_segments = list(executor.map(_encode_segment, segments))
+
+    for segment_flags, segment_sizes, segment_body in encoded_segments:
+        flags += segment_flags
+        sizes += segment_sizes
+        body += segment_body
+
+    return _pack_tokens(flags, sizes, body, len(data))
+
+
+def _compress_item(args):
+    data, level, time_budget = args
+    return compress_parallel(data, 1, level, time_budget)
+
+
+def compress_many(datas, workers=None, level=DEFAULT_LEVEL, time_budget=None):
+    # Compresses every input into its own Yaz0 stream. Several inputs are encoded at once
+    # in separate processes, a single input is split up by compress_parallel instead.
+    # Inputs that are too small in total to be worth starting processes for are encoded
+    # one after another. Each output is the same as that of compress_parallel, whatever the
+    # number of workers.
+    datas = [bytes(data) for data in datas]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if len(datas) == 1:
+        return [compress_parallel(datas[0], workers, level, time_budget)]
+    if workers <= 1 or sum(len(data) for data in datas) <= PARALLEL_SEGMENT_SIZE:
+        return [compress_parallel(data, 1, level, time_budget) for data in datas]
+
+    # Biggest inputs first so a big one at the end doesn't leave the other processes idle
+    order = sorted(range(len(datas)), key=lambda i: len(datas[i]), reverse=True)
+    results = [None]*len(datas)
+    with ProcessPoolExecutor(max_workers=min(workers, len(datas))) as executor:
+        for i, compressed in zip(order, executor.map(_compress_item, [(datas[i], level, time_budget) for i in order])):
+            results[i] = compressed
+
+    return results
+
+
+def compress(f, out, level=DEFAULT_LEVEL, workers=1, time_budget=None):
+    out.write(compress_parallel(f.read(), workers, level, time_budget))
+
+
+def compress_fast(f, out):
+    compress(f, out, level=1)
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description="Check Yaz0 files for errors without decompressing them and show statistics about them.")
+    parser.add_argument("input", nargs="+",
+                        help="Paths to the Yaz0-compressed files (usually .szs) to check.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the statistics of all files as JSON.")
+    args = parser.parse_args()
+
+    results = {}
+    for path in args.input:
+        with open(path, "rb") as f:
+            results[path] = validate(f.read())
+
+    if args.json:
+        print(json.dumps({path: stats.as_dict() for path, stats in results.items()}, indent=4))
+    else:
+        for path, stats in results.items():
+            print("{0}: {1}".format(path, "OK" if stats.valid else "INVALID"))
+            for error in stats.errors:
+                print("    {0}".format(error))
+            for warning in stats.warnings:
+                print("    Warning: {0}".format(warning))
+            print("    {0} -> {1} bytes, {2} literals, {3} back-references, {4} trailing bytes".format(
+                  stats.compressed_size, stats.decompressed_size, stats.literal_count, stats.match_count,
+                  stats.trailing_bytes))
+            print("    Match lengths:")
+            for length, count in stats.as_dict()["match_lengths"].items():
+                print("        {0:>3}: {1}".format(length, count))
+            print("    Distances:")
+            for distances, count in stats.as_dict()["distance_buckets"].items():
+                print("        {0:>9}: {1}".format(distances, count))
+
+    if not all(stats.valid for stats in results.values()):
+        exit(1)
@@ -0,0 +1,253 @@
+"""
+Benchmark and regression check for the Yaz0 codec.
+
+Generates synthetic corpora, measures the throughput of every decoder and encoder on them, checks
+that all encoders round-trip through all decoders, and optionally compares the results against a
+baseline from an earlier run:
+
+    python -m src.yaz0_benchmark --output results.json
+    python -m src.yaz0_benchmark --baseline results.json
+"""
+import argparse
+import json
+import platform
+import random
+import struct
+import sys
+import time
+
+from io import BytesIO
+
+from . import yaz0
+from .rarc import Archive, Directory, File
+
+# Relative throughput loss compared to the baseline that is reported as a regression.
+DEFAULT_TOLERANCE = 0.2
+
+
+def make_random(size: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+def make_repetitive(size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        if data and rng.random() < 0.5:
+            start = rng.randrange(max(1, len(data) - 0x1000), len(data))
+            data += data[start:start + rng.randrange(3, 0x111)]
+        else:
+            data += bytes([rng.randrange(16)]) * rng.randrange(1, 64)
+    return bytes(data[:size])
+
+
+def make_bti(size: int, seed: int) -> bytes:
+    # A BTI header followed by CMPR (S3TC-like) blocks: two RGB565 colors and 2-bit indices.
+    rng = random.Random(seed)
+    width = height = 256
+    data = bytearray(struct.pack('>BBHHBBBBHIBBBBBBHI', 0x0E, 0, width, height, 0, 0, 0, 0, 0, 0,
+                                 1, 1, 0, 0, 1, 0, 0, 0x20))
+    data += bytes(0x20 - len(data))
+    color = rng.randrange(0x10000)
+    while len(data) < size:
+        color = (color + rng.randrange(-0x84, 0x84)) & 0xFFFF
+        other_color = (color + rng.randrange(0x21)) & 0xFFFF
+        indices = bytes(rng.choice((0x00, 0x55, 0xAA, 0xFF, rng.randrange(0x100))) for _ in range(4))
+        data += struct.pack('>HH', max(color, other_color), min(color, other_color)) + indices
+    return bytes(data[:size])
+
+
+def make_rarc(size: int, seed: int) -> bytes:
+    # An archive like a course archive: a few models, textures and small parameter files.
+    rng = random.Random(seed)
+    root = Directory('course')
+    subdir = Directory('timg')
+    subdir.parent = root
+    root.subdirs[subdir.name] = subdir
+
+    total = 0
+    i = 0
+    while total < size:
+        kind = rng.random()
+        if kind < 0.4:
+            directory, name, data = subdir, f'tex{i}.bti', make_bti(rng.randrange(0x800, 0x8000), seed + i)
+        elif kind < 0.8:
+            directory, name, data = root, f'model{i}.bmd', make_repetitive(rng.randrange(0x800, 0x10000),
+                                                                         seed + i)
+        else:
+            directory, name, data = root, f'param{i}.bin', make_random(rng.randrange(0x20, 0x400),
+                                                                      seed + i)
+        file = File(name)
+        file.write(data)
+        file.seek(0)
+        directory.files[name] = file
+        total += len(data)
+        i += 1
+
+    archive = Archive()
+    archive.root = root
+    out = BytesIO()
+    archive.write_arc_uncompressed(out)
+    return out.getvalue()
+
+
+CORPORA = {
+    'random': make_random,
+    'repetitive': make_repetitive,
+    'bti': make_bti,
+    'rarc': make_rarc,
+}
+
+
+def _decode_file(compressed: bytes) -> bytes:
+    out = BytesIO()
+    yaz0.decompress(BytesIO(compressed), out)
+    return out.getvalue()
+
+
+def _decode_stream(compressed: bytes) -> bytes:
+    return bytes(yaz0.decompress_stream(BytesIO(compressed)))
+
+
+DECODERS = {
+    'decompress': _decode_file,
+    'decompress_buffer': lambda compressed: bytes(yaz0.decompress_buffer(compressed)),
+    'decompress_stream': _decode_stream,
+}
+
+
+def get_encoders(levels: list) -> dict:
+    encoders = {}
+
+    def compress_fast(data):
+        out = BytesIO()
+        yaz0.compress_fast(BytesIO(data), out)
+        return out.getvalue()
+
+    encoders['compress_fast'] = compress_fast
+    for level in levels:
+        encoders[f'level{level}'] = lambda data, level=level: bytes(yaz0.compress_buffer(data, level))
+
+    return encoders
+
+
+def _measure(func, arg, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def run(size: int, levels: list, repeat: int, corpora: list) -> dict:
+    results = {
+        'python': platform.python_version(),
+        'size': size,
+        'corpora': {},
+    }
+
+    for corpus_name in corpora:
+        data = CORPORA[corpus_name](size, 0)
+        corpus_results = {'size': len(data), 'encoders': {}, 'decoders': {}, 'errors': []}
+        reference = None
+
+        for encoder_name, encoder in get_encoders(levels).items():
+            compressed, elapsed = _measure(encoder, data, repeat)
+            corpus_results['encoders'][encoder_name] = {
+                'mb_per_s': len(data) / elapsed / 1e6 if elapsed else None,
+                'ratio': len(compressed) / len(data) if data else None,
+            }
+            if reference is None or len(compressed) < len(reference):
+                reference = compressed
+
+            for decoder_name, decoder in DECODERS.items():
+                try:
+                    if decoder(compressed)[:len(data)] != data:
+                        corpus_results['errors'].append(f'{encoder_name} -> {decoder_name}: mismatch')
+                except Exception as e:  # pylint: disable=broad-except
+                    corpus_results['errors'].append(f'{encoder_name} -> {decoder_name}: {e}')
+
+        # Decoders are timed on the smallest output, which has the most back-references.
+        for decoder_name, decoder in DECODERS.items():
+            _, elapsed = _measure(decoder, reference, repeat)
+            corpus_results['decoders'][decoder_name] = {
+                'mb_per_s': len(data) / elapsed / 1e6 if elapsed else None,
+            }
+
+        results['corpora'][corpus_name] = corpus_results
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for corpus_name, corpus_results in results['corpora'].items():
+        baseline_corpus = baseline.get('corpora', {}).get(corpus_name)
+        if baseline_corpus is None:
+            continue
+
+        for kind in ('encoders', 'decoders'):
+            for name, values in corpus_results[kind].items():
+                baseline_values = baseline_corpus.get(kind, {}).get(name)
+                if baseline_values is None:
+                    continue
+
+                speed, baseline_speed = values['mb_per_s'], baseline_values['mb_per_s']
+                if speed and baseline_speed and speed < baseline_speed * (1 - tolerance):
+                    regressions.append(f'{corpus_name}/{name}: {speed:.2f} MB/s, '
+                                       f'baseline {baseline_speed:.2f} MB/s')
+
+                ratio, baseline_ratio = values.get('ratio'), baseline_values.get('ratio')
+                if ratio and baseline_ratio and ratio > baseline_ratio * 1.001:
+                    regressions.append(f'{corpus_name}/{name}: ratio {ratio:.4f}, '
+                                       f'baseline {baseline_ratio:.4f}')
+
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the Yaz0 decoders and encoders.')
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='Size of every synthetic corpus in bytes.')
+    parser.add_argument('--levels', type=int, nargs='*', default=[1, yaz0.DEFAULT_LEVEL, 9],
+                        help='Levels of the built-in encoder to measure.')
+    parser.add_argument('--corpora', nargs='*', default=list(CORPORA), choices=list(CORPORA),
+                        help='Corpora to run the benchmark on.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs per measurement; the fastest one is used.')
+    parser.add_argument('--output', help='Write the results as JSON to this file instead of stdout.')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare the results to.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative throughput loss that is reported as a regression.')
+    args = parser.parse_args(argv)
+
+    results = run(args.size, args.levels, args.repeat, args.corpora)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = False
+    for corpus_name, corpus_results in results['corpora'].items():
+        for error in corpus_results['errors']:
+            print(f'Round-trip error in {corpus_name}: {error}', file=sys.stderr)
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for regression in compare(results, baseline, args.tolerance):
+            print(f'Regression: {regression}', file=sys.stderr)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
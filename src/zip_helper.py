@@ -4,18 +4,24 @@ import logging
 from io import BytesIO
 from pathlib import Path
 
+from .rarc import Archive
+
 log = logging.getLogger(__name__)
 
 
 class ZipLikeFolder(object):
     def __init__(self, filepath):
         self.filepath = filepath 
+        # Archives mapped by open_archive, which are closed together with the folder
+        self._archives = []
     
     def path(self, subpath):
         return Path(os.path.join(self.filepath, subpath))
     
     def close(self):
-        pass
+        for archive in self._archives:
+            archive.close()
+        self._archives = []
     
     # zipfile's open does not seem to expect to be closed after use.
     # To mimic that, we write files into BytesIO and return that.
@@ -30,6 +36,15 @@ class ZipLikeFolder(object):
         handle.seek(0)
         return handle
 
+    def open_archive(self, path, validate_yaz0=False):
+        # Maps the archive file instead of reading it into memory
+        filepath = os.path.join(self.filepath, path)
+        if not os.path.isfile(filepath):
+            raise KeyError("{0} not found.".format(path))
+        archive = Archive.open_mmap(filepath, validate_yaz0=validate_yaz0)
+        self._archives.append(archive)
+        return archive
+
     def namelist(self):
         result = []
         base = os.path.basename(self.filepath)
@@ -120,6 +135,13 @@ class ZipToIsoPatcher(object):
         fp = self.zip.open(self.root+filepath)
         return fp
     
+    def open_archive(self, filepath, validate_yaz0=False):
+        # Archives in folders are memory-mapped, archives in zip files are read from the zip
+        if self._is_folder:
+            return self.zip.open_archive(self.root+filepath, validate_yaz0=validate_yaz0)
+        else:
+            return Archive.from_file(self.zip_open(filepath), validate_yaz0=validate_yaz0)
+
     def get_file_changes(self, startpath, add_files=False):
         if self._is_folder:
             startpath = Path(os.path.basename(self.zip.filepath) + os.path.sep + startpath)
@@ -0,0 +1,62 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from src import compression_cache
+from src.compression_cache import CompressionCache
+
+
+class CompressionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dirpath = os.path.join(tmp_dir.name, 'cache')
+
+    def test_get_or_compress(self):
+        cache = CompressionCache(self.dirpath)
+        calls = []
+
+        def compress(data):
+            calls.append(data)
+            return data[::-1]
+
+        for _ in range(2):
+            self.assertEqual(cache.get_or_compress(b'abc', 'yaz0', 9, compress), b'cba')
+        self.assertEqual(calls, [b'abc'])
+        # A fresh cache finds the entry on disk
+        self.assertEqual(CompressionCache(self.dirpath).get_or_compress(b'abc', 'yaz0', 9, compress), b'cba')
+        self.assertEqual(len(calls), 1)
+
+    def test_time_budget_is_part_of_the_key(self):
+        keys = {CompressionCache.make_key(b'abc', 'yaz0', 10, time_budget) for time_budget in (None, 0, 10.0)}
+        self.assertEqual(len(keys), 3)
+
+    def test_corrupted_entry(self):
+        cache = CompressionCache(self.dirpath)
+        key = cache.make_key(b'abc', 'yaz0', 9)
+        cache.put(key, b'compressed')
+        filepath = os.path.join(self.dirpath, key + '.bin')
+        with open(filepath, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+
+        self.assertIsNone(CompressionCache(self.dirpath).get(key))
+        self.assertFalse(os.path.exists(filepath))
+
+    @unittest.skipIf(os.name != 'posix', 'permissions are only checked on POSIX systems')
+    def test_private_directory(self):
+        CompressionCache(self.dirpath).put('key', b'data')
+        self.assertEqual(stat.S_IMODE(os.stat(self.dirpath).st_mode), 0o700)
+
+        os.chmod(self.dirpath, 0o777)
+        self.assertEqual(CompressionCache(self.dirpath).get('key'), b'data')
+        self.assertEqual(stat.S_IMODE(os.stat(self.dirpath).st_mode), 0o700)
+
+    def test_default_directory_is_per_user(self):
+        self.assertFalse(compression_cache.DEFAULT_CACHE_DIRPATH.startswith(tempfile.gettempdir()))
+
+
+if __name__ == '__main__':
+    unittest.main()
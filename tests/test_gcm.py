@@ -0,0 +1,124 @@
+import os
+import random
+import tempfile
+import unittest
+
+from io import BytesIO
+from unittest import mock
+
+from src.gcm import GCM, COPY_METHODS, DiscFileData, SystemFile
+
+
+class CopyInputIsoDataTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data = random.Random(0).randbytes(100000)
+        self.iso_path = os.path.join(tmp_dir.name, 'input.iso')
+        with open(self.iso_path, 'wb') as f:
+            f.write(self.data)
+        self.output_path = os.path.join(tmp_dir.name, 'output.bin')
+
+        self.iso = GCM(self.iso_path)
+        self.iso.open_input_iso()
+        self.addCleanup(self.iso.close_input_iso)
+
+    def copy(self, offset: int, size: int) -> bytes:
+        with open(self.output_path, 'w+b') as f:
+            f.write(b'x')
+            self.iso.copy_input_iso_data(f, offset, size)
+            self.assertEqual(f.tell(), 1 + size)
+            f.seek(1)
+            return f.read()
+
+    def test_copy_methods(self):
+        for copy_method in COPY_METHODS:
+            if copy_method != 'readinto' and not hasattr(os, copy_method):
+                continue
+            self.iso.copy_method = copy_method
+            self.assertEqual(self.copy(1000, 50000), self.data[1000:51000], copy_method)
+
+    def test_kernel_copy_stops_early(self):
+        # Some filesystems make copy_file_range copy nothing instead of failing
+        for copy_method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, copy_method):
+                continue
+            self.iso.copy_method = copy_method
+            with mock.patch.object(os, copy_method, return_value=0):
+                self.assertEqual(self.copy(1000, 50000), self.data[1000:51000], copy_method)
+
+    def test_input_too_short(self):
+        for copy_method in COPY_METHODS:
+            if copy_method != 'readinto' and not hasattr(os, copy_method):
+                continue
+            self.iso.copy_method = copy_method
+            with self.assertRaises(Exception):
+                self.copy(90000, 20000)
+
+
+class DiscFileDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = random.Random(1).randbytes(1000)
+        self.view = memoryview(self.data).toreadonly()
+
+    def test_read(self):
+        file = DiscFileData(self.view)
+        reference = BytesIO(self.data)
+        for pos, whence, size in ((10, 0, 20), (-5, 1, 3), (-100, 2, -1), (2000, 0, 10), (-3000, 2, 5)):
+            self.assertEqual(file.seek(pos, whence), reference.seek(pos, whence))
+            self.assertEqual(file.read(size), reference.read(size))
+            self.assertEqual(file.tell(), reference.tell())
+        with self.assertRaises(ValueError):
+            file.seek(-1)
+
+        file.seek(990)
+        buffer = bytearray(20)
+        self.assertEqual(file.readinto(buffer), 10)
+        self.assertEqual(bytes(buffer[:10]), self.data[990:])
+        self.assertIs(file.data, None)
+
+    def test_no_copy_on_unknown_attributes(self):
+        file = DiscFileData(self.view)
+        self.assertTrue(hasattr(file, 'getview'))
+        self.assertFalse(hasattr(file, 'missing'))
+        self.assertIs(file.getview(), self.view)
+        self.assertIs(file.data, None)
+
+    def test_copy_on_write(self):
+        file = DiscFileData(self.view)
+        reference = BytesIO(self.data)
+        for f in (file, reference):
+            f.seek(998)
+            f.write(b'abcd')
+            f.seek(10)
+            f.truncate()
+            f.writelines([b'x', b'yz'])
+        self.assertEqual(file.getvalue(), reference.getvalue())
+        self.assertEqual(bytes(file.getbuffer()), reference.getvalue())
+        self.assertEqual(bytes(self.view), self.data)
+
+
+class CloseTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.data = random.Random(2).randbytes(10000)
+        self.iso_path = os.path.join(tmp_dir.name, 'input.iso')
+        with open(self.iso_path, 'wb') as f:
+            f.write(self.data)
+
+    def test_close(self):
+        with GCM(self.iso_path) as iso:
+            iso.files_by_path_lowercase['sys/test.bin'] = SystemFile(1000, 500, 'test.bin')
+            file_data = iso.read_file_data('sys/test.bin')
+            iso_map = iso.iso_map
+        self.assertTrue(iso_map.closed)
+        # Files that were read from the ISO keep their data
+        self.assertEqual(file_data.read(), self.data[1000:1500])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from unittest import mock
+
+from src.patcher import rename_archive
+from src.rarc import Archive, Directory, File
+
+
+def make_track_archive(name: str = 'mario') -> Archive:
+    archive = Archive()
+    archive.root = Directory(name)
+    for filename in (f'{name}_course.bmd', f'{name}_course.bco', 'objects.bin'):
+        archive.root.files[filename] = File(filename)
+    return archive
+
+
+class RenameArchiveTest(unittest.TestCase):
+
+    def test_rename(self):
+        archive = make_track_archive()
+        course = archive['mario/mario_course.bmd']
+        rename_archive(archive, 'luigi', True)
+
+        self.assertEqual(archive.root.name, 'luigil')
+        self.assertEqual(sorted(archive.root.files),
+                         ['luigi_course.bco', 'luigi_course.bmd', 'objects.bin'])
+        # The renamed paths are in the index, so they are found without walking the tree
+        with mock.patch.object(Archive, '_find') as find:
+            self.assertIs(archive['luigil/luigi_course.bmd'], course)
+            self.assertIs(archive['luigil/objects.bin'], archive.root.files['objects.bin'])
+        find.assert_not_called()
+        with self.assertRaises(FileNotFoundError):
+            archive['mario/mario_course.bmd']
+
+    def test_rename_onto_existing_file(self):
+        archive = make_track_archive()
+        archive.root.files['luigi_course.bmd'] = File('luigi_course.bmd')
+        with self.assertRaises(FileExistsError):
+            rename_archive(archive, 'luigi', False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import os
+import tempfile
+import unittest
+
+from io import BytesIO
+from unittest import mock
+
+from struct import pack_into, unpack_from
+
+from src.rarc import Archive, CompressionSetting, Directory, File, FileListing, list_files
+from src.yaz0 import compress_buffer
+from src.zip_helper import ZipLikeFolder
+
+
+def make_archive(filecount: int = 3) -> Archive:
+    archive = Archive()
+    archive.root = Directory('course')
+    subdir = Directory('timg')
+    subdir.parent = archive.root
+    archive.root.subdirs['timg'] = subdir
+    for i in range(filecount):
+        archive.root.files[f'File{i}.bin'] = File(f'File{i}.bin')
+    subdir.files['Texture.bti'] = File('Texture.bti')
+    return archive
+
+
+class IndexTest(unittest.TestCase):
+
+    def test_lookup_without_regard_to_case(self):
+        archive = make_archive()
+        self.assertIs(archive['course/timg/texture.BTI'], archive.root.subdirs['timg'].files['Texture.bti'])
+        self.assertIs(archive['COURSE\\file1.bin'], archive.root.files['File1.bin'])
+
+    def test_direct_changes(self):
+        archive = make_archive()
+        archive['course/File0.bin']  # Builds the index
+
+        del archive.root.files['File0.bin']
+        with self.assertRaises(FileNotFoundError):
+            archive['course/File0.bin']
+
+        replacement = File('File1.bin')
+        archive.root.files['File1.bin'] = replacement
+        self.assertIs(archive['course/file1.bin'], replacement)
+
+        added = File('New.bin')
+        archive.root.subdirs['timg'].files['New.bin'] = added
+        self.assertIs(archive['course/timg/new.bin'], added)
+
+        archive.root.name = 'renamed'
+        self.assertIs(archive['renamed/File1.bin'], replacement)
+        with self.assertRaises(FileNotFoundError):
+            archive['course/File1.bin']
+
+    def test_changes_through_archive(self):
+        archive = make_archive()
+        added = File('Added.bin')
+        archive['course/timg/Added.bin'] = added
+        self.assertIs(archive['course/timg/added.bin'], added)
+
+        archive.rename('course/timg', 'textures')
+        self.assertIs(archive['course/textures/Added.bin'], added)
+        with self.assertRaises(FileNotFoundError):
+            archive['course/timg/Added.bin']
+
+        archive.remove('course/textures')
+        with self.assertRaises(FileNotFoundError):
+            archive['course/textures/Texture.bti']
+        self.assertEqual(archive.listdir('course'), ['File0.bin', 'File1.bin', 'File2.bin'])
+
+    def test_replacing_files_keeps_the_index(self):
+        # Replacing a file only updates the index entries of that file, so lookups neither
+        # rebuild the index nor walk the directory tree
+        archive = make_archive(100)
+        archive['course/File0.bin']
+        with mock.patch.object(Archive, 'reindex', wraps=archive.reindex) as reindex, \
+                mock.patch.object(Archive, '_find', wraps=archive._find) as find:
+            for i in range(100):
+                replacement = File(f'File{i}.bin')
+                archive[f'course/File{i}.bin'] = replacement
+                self.assertIs(archive[f'course/file{i}.bin'], replacement)
+        reindex.assert_not_called()
+        find.assert_not_called()
+
+
+class WriteInPlaceTest(unittest.TestCase):
+
+    def setUp(self):
+        # Non-default file ids and flags, like in the archives of the game
+        archive = make_archive()
+        filelisting = {}
+        for i, path in enumerate(['course/File0.bin', 'course/File1.bin', 'course/File2.bin',
+                                  'course/timg/Texture.bti']):
+            archive[path].write(bytes([i + 1]) * 100)
+            filelisting[path] = (10 + i, FileListing.from_string('yaz0_compressed' if i == 1 else ''))
+        self.data = bytes(archive.build_arc(CompressionSetting(), filelisting))
+
+    def write_in_place(self, data: bytes, changes: dict) -> tuple:
+        archive = Archive.from_buffer(data)
+        for path, filedata in changes.items():
+            file = archive[path]
+            file.seek(0)
+            file.write(filedata)
+            file.truncate()
+        output = BytesIO()
+        patched = archive.write_arc_in_place(output)
+        return patched, output.getvalue()
+
+    @staticmethod
+    def entries(data: bytes) -> list:
+        return sorted((path, fileid, flags) for path, fileid, flags, _ in list_files(BytesIO(data)))
+
+    def test_both_paths_keep_ids_and_flags(self):
+        patched, in_place = self.write_in_place(self.data, {'course/File1.bin': b'small'})
+        self.assertTrue(patched)
+        patched, rewritten = self.write_in_place(self.data, {'course/File1.bin': b'big' * 100})
+        self.assertFalse(patched)
+
+        self.assertEqual(self.entries(in_place), self.entries(self.data))
+        self.assertEqual(self.entries(rewritten), self.entries(self.data))
+        self.assertEqual(Archive.from_buffer(in_place)['course/File1.bin'].getvalue(), b'small')
+        self.assertEqual(Archive.from_buffer(rewritten)['course/File1.bin'].getvalue(), b'big' * 100)
+
+    def test_filetype_changes_are_kept(self):
+        archive = Archive.from_buffer(self.data)
+        file = archive['course/File0.bin']
+        self.assertFalse(file.filetype.is_yaz0)
+        file.filetype.is_yaz0 = True
+        file.filetype.is_compressed = True
+        self.assertTrue(file.filetype.is_yaz0)
+        self.assertTrue(file.is_yaz0_compressed())
+
+        # The changed flags don't fit the entry any more, so the archive is rewritten with them
+        output = BytesIO()
+        self.assertFalse(archive.write_arc_in_place(output))
+        flags = {path: flags for path, _, flags in self.entries(output.getvalue())}
+        self.assertEqual(flags['course/File0.bin'], FileListing.from_string('yaz0_compressed').to_flags())
+
+        file.filetype = FileListing.default()
+        self.assertFalse(file.filetype.is_yaz0)
+
+    def test_shared_data_is_not_overwritten(self):
+        # Let the entry of File2.bin point to the data of File1.bin
+        data = bytearray(self.data)
+        entry_offset = unpack_from('>I', data, 0x2C)[0] + 0x20
+        file1_offset = unpack_from('>I', data, entry_offset + 1*0x14 + 8)[0]
+        pack_into('>I', data, entry_offset + 2*0x14 + 8, file1_offset)
+
+        patched, output = self.write_in_place(bytes(data), {'course/File1.bin': b'small'})
+        self.assertFalse(patched)
+        archive = Archive.from_buffer(output)
+        self.assertEqual(archive['course/File1.bin'].getvalue(), b'small')
+        self.assertEqual(archive['course/File2.bin'].getvalue(), bytes([2]) * 100)
+
+
+class CloseTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'course.arc')
+        archive = make_archive()
+        archive['course/File1.bin'].write(b'data')
+        with open(self.path, 'wb') as f:
+            archive.write_arc_uncompressed(f)
+
+    def test_close(self):
+        with Archive.open_mmap(self.path) as archive:
+            mapping = archive._mapping
+            file = archive['course/File1.bin']
+        self.assertTrue(mapping.closed)
+        # The files can still be used
+        self.assertEqual(file.getvalue(), b'data')
+        self.assertEqual(archive['course/File1.bin'].getvalue(), b'data')
+        archive.close()
+
+    def test_folder_closes_archives(self):
+        folder = ZipLikeFolder(os.path.dirname(self.path))
+        archive = folder.open_archive('course.arc')
+        mapping = archive._mapping
+        folder.close()
+        self.assertTrue(mapping.closed)
+
+
+class ListFilesTest(unittest.TestCase):
+
+    def test_list_files(self):
+        archive = make_archive()
+        for i, file in enumerate(archive.root.files.values()):
+            file.write(bytes([i]) * (100 + i))
+        output = BytesIO()
+        archive.write_arc_uncompressed(output)
+        data = output.getvalue()
+
+        expected = list_files(BytesIO(data))
+        self.assertEqual(sorted(path for path, _, _, _ in expected),
+                         ['course/File0.bin', 'course/File1.bin', 'course/File2.bin', 'course/timg/Texture.bti'])
+        # Only the header of the archive is decompressed, from a stream that is read once
+        compressed = BytesIO(bytes(compress_buffer(data)))
+        self.assertEqual(list_files(compressed), expected)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_no_differences(self):
+        self.assertFalse(make_archive().diff(make_archive()))
+
+    def test_files(self):
+        archive = make_archive()
+        other = make_archive()
+        del other.root.files['File0.bin']
+        other.root.files['File1.bin'].write(b'changed')
+        other.root.subdirs['timg'].files['New.bti'] = File('New.bti')
+        result = archive.diff(other)
+        self.assertEqual(result.removed, ['File0.bin'])
+        self.assertEqual(result.changed, ['File1.bin'])
+        self.assertEqual(result.added, ['timg/New.bti'])
+        self.assertIsNone(result.root_renamed)
+
+    def test_root_name(self):
+        other = make_archive()
+        other.root.name = 'renamed'
+        result = make_archive().diff(other)
+        self.assertTrue(result)
+        self.assertEqual(result.root_renamed, ('course', 'renamed'))
+        self.assertEqual(str(result), 'R course -> renamed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import random
+import tempfile
+import unittest
+
+from unittest import mock
+
+from src import wszst
+from src.rarc import CompressionSetting
+from src.yaz0 import decompress_buffer
+
+STUB_EXECUTABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wszst_stub.py')
+
+
+@unittest.skipIf(os.name == 'nt', 'the stub is started through its shebang line')
+class WszstTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.log_filepath = tempfile.mkstemp(suffix='.log')
+        os.close(handle)
+        patcher = mock.patch.dict(os.environ, {'WSZST_STUB_LOG': self.log_filepath})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(os.remove, self.log_filepath)
+
+        rng = random.Random(0)
+        self.datas = [rng.randbytes(rng.randrange(1, 3000)) for _ in range(5)]
+
+    def calls(self) -> list:
+        with open(self.log_filepath, encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def test_compress(self):
+        compressed = wszst.compress(self.datas[0], '9', STUB_EXECUTABLE)
+        self.assertEqual(bytes(decompress_buffer(compressed)), self.datas[0])
+        self.assertEqual(len(self.calls()), 1)
+
+    def test_compress_batch(self):
+        compressed_datas = wszst.compress_batch(self.datas, '9', STUB_EXECUTABLE)
+        self.assertEqual([bytes(decompress_buffer(data)) for data in compressed_datas], self.datas)
+        self.assertEqual(len(self.calls()), 1)
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError) as context:
+            wszst.compress(self.datas[0], 'fastest', STUB_EXECUTABLE)
+        self.assertIn('invalid compression level', str(context.exception))
+
+    def test_pool(self):
+        with wszst.WszstPool('9', STUB_EXECUTABLE, max_workers=2, batch_size=2) as pool:
+            compressed_datas = pool.map(self.datas)
+        self.assertEqual([bytes(decompress_buffer(data)) for data in compressed_datas], self.datas)
+        # Batches of 2, 2 and 1 inputs
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_pool_error(self):
+        with wszst.WszstPool('fastest', STUB_EXECUTABLE, batch_size=2) as pool:
+            futures = [pool.submit(data) for data in self.datas[:3]]
+            pool.flush()
+            for future in futures:
+                self.assertIsInstance(future.exception(), RuntimeError)
+
+    def test_compression_setting(self):
+        setting = CompressionSetting(wszst=True, wszst_executable=STUB_EXECUTABLE)
+        try:
+            compressed_datas = setting.compress_many(self.datas)
+            compressed = setting.compress(self.datas[0])
+        finally:
+            setting.close()
+        # The stub doesn't compress, so the uncompressed data is kept
+        self.assertEqual(compressed_datas, self.datas)
+        self.assertEqual(compressed, self.datas[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import random
+import unittest
+
+from unittest import mock
+
+from src import yaz0
+
+
+class CountingBytes(bytes):
+    # Counts how often the encoder reads from the data
+
+    reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return super().__getitem__(key)
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        datas = [
+            b'',
+            b'a',
+            rng.randbytes(100),
+            rng.randbytes(5000),
+            bytes(rng.randrange(4) for _ in range(20000)),
+            b'abc' * 3000,
+        ]
+        for level in range(1, yaz0.OPTIMAL_LEVEL + 1):
+            for data in datas:
+                compressed = yaz0.compress_buffer(data, level)
+                self.assertEqual(bytes(yaz0.decompress_buffer(compressed)), data, f'level {level}')
+
+    def test_chain_end_stops_the_match_search(self):
+        # The end of the hash chains used to be followed as a match candidate for the first
+        # WINDOW_SIZE positions, so every position walked the whole chain length at levels 7 and
+        # up. Random data has almost no matches, so the data is only read a few times per position.
+        data = CountingBytes(random.Random(1).randbytes(yaz0.WINDOW_SIZE))
+        for level in (7, 9, yaz0.OPTIMAL_LEVEL):
+            data.reads = 0
+            yaz0._encode_tokens(data, 0, len(data), level)
+            self.assertLess(data.reads, 10 * len(data), f'level {level}')
+
+    @mock.patch.object(yaz0, 'PARALLEL_SEGMENT_SIZE', 0x4000)
+    def test_output_does_not_depend_on_workers(self):
+        # Compressed data is cached by its input and level only
+        data = bytes(random.Random(3).randrange(4) for _ in range(2 * yaz0.PARALLEL_SEGMENT_SIZE + 1000))
+        compressed = yaz0.compress_parallel(data, 1, 1)
+        self.assertEqual(bytes(yaz0.decompress_buffer(compressed)), data)
+        self.assertEqual(yaz0.compress_parallel(data, 2, 1), compressed)
+        self.assertEqual(yaz0.compress_many([data], 2, 1), [compressed])
+        self.assertEqual(yaz0.compress_many([data, b'abc' * 100], 2, 1)[0], compressed)
+        self.assertEqual(yaz0.compress_many([data, b'abc' * 100], 1, 1)[0], compressed)
+
+    def test_optimal_parse_time_budget(self):
+        # Once the budget has run out, the rest is compressed like level OPTIMAL_FALLBACK_LEVEL
+        data = bytes(random.Random(2).randrange(4) for _ in range(3 * yaz0.OPTIMAL_BLOCK_SIZE))
+        compressed = yaz0.compress_buffer(data, yaz0.OPTIMAL_LEVEL, time_budget=0)
+        self.assertEqual(bytes(yaz0.decompress_buffer(compressed)), data)
+        self.assertEqual(compressed, yaz0.compress_buffer(data, yaz0.OPTIMAL_FALLBACK_LEVEL))
+
+
+class ValidateTest(unittest.TestCase):
+
+    @staticmethod
+    def make_stream(decompressed_size, body):
+        return b'Yaz0' + decompressed_size.to_bytes(4, 'big') + bytes(8) + body
+
+    def test_valid(self):
+        stats = yaz0.validate(yaz0.compress_buffer(b'abc' * 100, 9))
+        self.assertTrue(stats.valid)
+        self.assertEqual(stats.warnings, [])
+
+    def test_back_reference_past_end_is_a_warning(self):
+        # A literal and a back-reference of 5 bytes for a declared size of 4
+        data = self.make_stream(4, b'\x80a\x30\x00')
+        stats = yaz0.validate(data)
+        self.assertTrue(stats.valid)
+        self.assertEqual(len(stats.warnings), 1)
+        self.assertEqual(stats.match_count, 1)
+        self.assertEqual(bytes(yaz0.decompress_buffer(data)), b'aaaa')
+
+    def test_trailing_data_is_a_warning(self):
+        data = yaz0.compress_buffer(b'abc' * 100, 9) + b'garbage'
+        stats = yaz0.validate(data)
+        self.assertTrue(stats.valid)
+        self.assertEqual(len(stats.warnings), 1)
+        self.assertEqual(bytes(yaz0.decompress_buffer(data)), b'abc' * 100)
+
+    def test_truncated_is_an_error(self):
+        stats = yaz0.validate(yaz0.compress_buffer(b'abc' * 100, 9)[:-4])
+        self.assertFalse(stats.valid)
+
+    def test_distance_before_start_is_an_error(self):
+        # A back-reference with distance 2 after a single literal
+        stats = yaz0.validate(self.make_stream(4, b'\x80a\x20\x01'))
+        self.assertFalse(stats.valid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Stand-in for wszst in the tests, so they run without wszst installed.
+
+Only the COMPRESS command is supported, with the arguments that src.wszst passes: source files,
+--dest with a file or a directory ending with a path separator, and --compr. The output is Yaz0 data that consists of literals only. If WSZST_STUB_LOG is set, every
+call appends its arguments as a line to that file.
+"""
+import os
+import struct
+import sys
+
+
+def compress(data: bytes) -> bytes:
+    out = bytearray(b'Yaz0' + struct.pack('>I', len(data)) + bytes(8))
+    for i in range(0, len(data), 8):
+        chunk = data[i:i + 8]
+        out.append((0xFF00 >> len(chunk)) & 0xFF)
+        out += chunk
+    return bytes(out)
+
+
+def fail(message: str):
+    print(f'wszst_stub: {message}', file=sys.stderr)
+    sys.exit(1)
+
+
+def main(args: list) -> None:
+    log_filepath = os.environ.get('WSZST_STUB_LOG')
+    if log_filepath:
+        with open(log_filepath, 'a', encoding='utf-8') as f:
+            f.write(' '.join(args) + '\n')
+
+    if not args or args[0] != 'COMPRESS':
+        fail('only COMPRESS is supported')
+
+    sources = []
+    dest = None
+    level = None
+    i = 1
+    while i < len(args):
+        if args[i] in ('--dest', '--compr'):
+            if i + 1 == len(args):
+                fail(f'missing value for {args[i]}')
+            if args[i] == '--dest':
+                dest = args[i + 1]
+            else:
+                level = args[i + 1]
+            i += 2
+        elif args[i].startswith('--'):
+            fail(f'unknown option {args[i]}')
+        else:
+            sources.append(args[i])
+            i += 1
+
+    if not sources or dest is None:
+        fail('sources and --dest are required')
+    if level is None or not level.isdigit():
+        fail(f'invalid compression level {level}')
+
+    for source in sources:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+        if dest.endswith(os.sep):
+            # Like wszst, the files get the extension of the compressed format
+            stem = os.path.splitext(os.path.basename(source))[0]
+            dest_filepath = os.path.join(dest, stem + '.szs')
+        elif len(sources) == 1:
+            dest_filepath = dest
+        else:
+            fail('--dest has to be a directory for several sources')
+        with open(dest_filepath, 'wb') as f:
+            f.write(compress(data))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])